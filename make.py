@@ -21,6 +21,10 @@ epocroot2 = 'C:\\Symbian\\7.0s\\Series60_v20_CW'
 # full path to ensymble 0.27+
 ensymble = 'ensymble.py'
 
+# folders with Python sources scanned by make_calltips.py (Python 2.2
+# standard library and the PyS60 library modules)
+calltips_sources = ['C:\\Python22\\Lib', 'C:\\PyS60\\lib']
+
 def main():
 
     # commands used in 3rd edition build, used twice later
@@ -30,6 +34,7 @@ def main():
         copy ped.pyo build_3rdEd\\ped.pyc
         copy ui.pyo build_3rdEd\\ui.pyc
         copy LICENSE build_3rdEd
+        copy calltips.bin build_3rdEd
         copy plugins\\__init__.pyo build_3rdEd\\plugins\\__init__.pyc
         copy ped_file_browser_icons.mif build_3rdEd\\root\\resource\\apps
         xcopy lang build_3rdEd\\lang /s
@@ -64,15 +69,19 @@ def main():
         'plugins\\__init__.pyo': (['plugins\\__init__.py'],
             lambda: system('''%s -O compile.py plugins\\__init__.py''' % python22)),
 
+        'calltips.bin': (['make_calltips.py'],
+            lambda: system('''%s make_calltips.py calltips.bin %s''' % (python22,
+                ' '.join(calltips_sources)))),
+
         'Ped_%s_2ndEd.sis' % verstr():
             (['ped_2ndEd.pkg', 'default.py', 'ped.pyo', 'ui.pyo', 'ped.aif', 'ped_2ndEd.app',
                 'plugins\\__init__.pyo', 'ped.rsc', 'ped_file_browser_icons.mbm',
-                'ped_file_browser_icons.mif', 'LICENSE'],
+                'ped_file_browser_icons.mif', 'LICENSE', 'calltips.bin'],
             lambda: build_sis_pre3('2ndEd')),
         
         'Ped_%s_3rdEd_unsigned_testrange.sis' % verstr():
             (['default.py', 'ped.pyo', 'ui.pyo', 'plugins\\__init__.pyo', 'ped.svg',
-                'ped_file_browser_icons.mif', 'LICENSE'],
+                'ped_file_browser_icons.mif', 'LICENSE', 'calltips.bin'],
             # Note. We let ensymble choose a test-range UID for us based on 'Ped' name.
             lambda: system(ped_3rded_system % \
                 ('--caps=PowerMgmt+ReadDeviceData+WriteDeviceData+TrustedUI+ProtServ+SwEvent+NetworkServices+LocalServices+ReadUserData+WriteUserData+Location+SurroundingsDD+UserEnvironment',
@@ -80,7 +89,7 @@ def main():
     
         'Ped_%s_3rdEd_no_caps.sis' % verstr():
             (['default.py', 'ped.pyo', 'ui.pyo', 'plugins\\__init__.pyo', 'ped.svg',
-                'ped_file_browser_icons.mif', 'LICENSE'],
+                'ped_file_browser_icons.mif', 'LICENSE', 'calltips.bin'],
             # Note. This UID was registered on symbiansigned.com
             lambda: system(ped_3rded_system % \
                 ('--uid=0xA00042B5',
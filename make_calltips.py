@@ -0,0 +1,163 @@
+#
+# make_calltips.py
+#
+# Scans Python source files and generates the calltips database used by
+# Ped for modules which are not imported in the shell. Sources are parsed,
+# not imported, so the PyS60 library can be scanned on a desktop machine.
+#
+# Database format:
+#   'PCT1', offset of the index (4 bytes, little endian),
+#   entries (marshalled (args, doc) tuples of unicode strings),
+#   index (marshalled {'module.name': (offset, size)} dictionary).
+#
+
+import os
+import sys
+import marshal
+import struct
+import compiler
+from compiler import ast
+from compiler.consts import CO_VARARGS, CO_VARKEYWORDS
+
+magic = 'PCT1'
+
+def expr_to_str(node):
+    '''Returns the source of a simple expression (used for default values).
+    '''
+    if isinstance(node, ast.Const):
+        return repr(node.value)
+    if isinstance(node, ast.Name):
+        return node.name
+    if isinstance(node, ast.Getattr):
+        return '%s.%s' % (expr_to_str(node.expr), node.attrname)
+    if isinstance(node, ast.UnarySub):
+        return '-%s' % expr_to_str(node.expr)
+    if isinstance(node, ast.Tuple):
+        items = [expr_to_str(x) for x in node.nodes]
+        if len(items) == 1:
+            return '(%s,)' % items[0]
+        return '(%s)' % ', '.join(items)
+    if isinstance(node, ast.List):
+        return '[%s]' % ', '.join([expr_to_str(x) for x in node.nodes])
+    if isinstance(node, ast.Dict) and not node.items:
+        return '{}'
+    return '...'
+
+def arg_to_str(arg):
+    if isinstance(arg, tuple):
+        return '(%s)' % ', '.join(map(arg_to_str, arg))
+    return arg
+
+def format_args(func, method=False):
+    '''Returns the arguments of an ast.Function as a string; the first
+    argument of methods is skipped.
+    '''
+    names = list(func.argnames)
+    varkw = varargs = None
+    if func.flags & CO_VARKEYWORDS:
+        varkw = names.pop()
+    if func.flags & CO_VARARGS:
+        varargs = names.pop()
+    defaults = [None] * (len(names) - len(func.defaults)) + list(func.defaults)
+    items = []
+    for name, default in zip(names, defaults):
+        if default is None:
+            items.append(arg_to_str(name))
+        else:
+            items.append('%s=%s' % (arg_to_str(name), expr_to_str(default)))
+    if varargs:
+        items.append('*' + varargs)
+    if varkw:
+        items.append('**' + varkw)
+    if method and names:
+        del items[0]
+    return ', '.join(items)
+
+def clean_doc(doc):
+    if not doc:
+        return u''
+    doc = doc.strip()
+    if isinstance(doc, str):
+        doc = doc.decode('latin1')
+    return doc
+
+def collect(node, prefix, entries, method=False):
+    '''Adds the functions and classes defined in node (not in nested
+    functions) to entries as {'name': (args, doc)}.
+    '''
+    for child in node.getChildNodes():
+        if isinstance(child, ast.Function):
+            if not child.name.startswith('_') or method and child.name == '__init__':
+                entries[prefix + child.name] = (format_args(child, method).decode('latin1'),
+                    clean_doc(child.doc))
+        elif isinstance(child, ast.Class):
+            if child.name.startswith('_'):
+                continue
+            name = prefix + child.name
+            args = ''
+            for x in child.code.nodes:
+                if isinstance(x, ast.Function) and x.name == '__init__':
+                    args = format_args(x, True)
+            entries[name] = (args.decode('latin1'), clean_doc(child.doc))
+            collect(child.code, name + '.', entries, True)
+        elif isinstance(child, (ast.Stmt, ast.If, ast.TryExcept, ast.TryFinally)):
+            collect(child, prefix, entries, method)
+
+def scan_file(filename, module, entries):
+    f = open(filename, 'rb')
+    source = f.read()
+    f.close()
+    try:
+        tree = compiler.parse(source.replace('\r\n', '\n') + '\n')
+    except (SyntaxError, ValueError):
+        print '> %s: syntax error, skipped' % filename
+        return
+    collect(tree.node, module + '.', entries)
+
+def scan(path, entries, package=''):
+    '''Scans the modules in a folder and its packages.
+    '''
+    for name in os.listdir(path):
+        filename = os.path.join(path, name)
+        base, ext = os.path.splitext(name)
+        if os.path.isdir(filename):
+            if os.path.isfile(os.path.join(filename, '__init__.py')):
+                scan(filename, entries, package + name + '.')
+        elif ext.lower() == '.py':
+            if base == '__init__':
+                if package:
+                    scan_file(filename, package[:-1], entries)
+            else:
+                scan_file(filename, package + base, entries)
+
+def write(filename, entries):
+    f = open(filename, 'wb')
+    f.write(magic + struct.pack('<I', 0))
+    index = {}
+    names = entries.keys()
+    names.sort()
+    for name in names:
+        data = marshal.dumps(entries[name])
+        index[name] = (f.tell(), len(data))
+        f.write(data)
+    offset = f.tell()
+    marshal.dump(index, f)
+    f.seek(len(magic))
+    f.write(struct.pack('<I', offset))
+    f.close()
+
+def main():
+    args = sys.argv[1:]
+    if len(args) < 2:
+        sys.exit('usage: make_calltips.py <calltips.bin> <folder or file.py> ...')
+    entries = {}
+    for path in args[1:]:
+        if os.path.isdir(path):
+            scan(path, entries)
+        else:
+            scan_file(path, os.path.splitext(os.path.basename(path))[0], entries)
+    write(args[0], entries)
+    print '> %s: %d entries' % (args[0], len(entries))
+
+if __name__ == '__main__':
+    main()
@@ -34,6 +34,8 @@
 #
 
 
+from __future__ import generators
+
 # application version
 __version__ = '2.30.5 beta'
 
@@ -41,7 +43,17 @@ __version__ = '2.30.5 beta'
 import sys
 import e32
 import os
+import time
 import ui
+from bisect import bisect_left, bisect_right
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+try:
+    from weakref import WeakKeyDictionary, ref as weakref
+except ImportError:
+    WeakKeyDictionary = weakref = None
 
 
 symbols = [('()', 1),
@@ -255,6 +267,8 @@ class RootWindow(ui.RootWindow, GlobalWindowModifier):
             self.shutdown()
     
     def shutdown(self):
+        app.completion_store.try_to_save()
+        app.module_index.try_to_save()
         # restore stdio redirection
         sys.stdin, sys.stdout, sys.stderr = self.old_stdio
         # exit application
@@ -316,11 +330,373 @@ class Window(ui.Window, GlobalWindowModifier):
         return ui.Window.control_key_press(self, key)
 
 
+# keeps the offsets of all lines of a ui.Text control so the line containing
+# a position can be found using a binary search instead of splitting the whole
+# text; the table is updated in place by the TextWindow editing methods
+# (add_text(), delete_text() and set_text()); changes made directly in the
+# control (by the user typing) are detected using the positions passed to
+# touched() by the key handler and by comparing the length of the text;
+# only the lines around these positions and the caret are scanned again
+class LineTable(object):
+    # number of line starts on each side of a repaired range which are
+    # checked before the repair is accepted
+    check_lines = 3
+
+    def __init__(self, body):
+        self.body = body
+        # caret position at the last sync()
+        self.caret = 0
+        self.reset(body.get())
+        self.remember(0)
+
+    # rebuilds the whole table from given text
+    def reset(self, text):
+        self.starts = [0] + self.scan(text, 0)
+        self.length = len(text)
+        # lowest position and shortest distance from the end of text
+        # touched by the user since last sync()
+        self.low = self.tail = None
+        # length of the end of the text not changed by the last sync(),
+        # None if the changed range was only guessed
+        self.sync_tail = 0
+        # (offset, text) of the lines remembered by remember()
+        self.line = None
+
+    # returns offsets of lines starting inside of text (after its line breaks),
+    # offset is the position of text in the control
+    def scan(self, text, offset):
+        starts = []
+        for line in text.splitlines(True):
+            offset += len(line)
+            starts.append(offset)
+        if starts and line.splitlines() == [line]:
+            # text doesn't end with a line break
+            del starts[-1]
+        return starts
+
+    # removes the line break from the end of line
+    def strip(self, line):
+        lst = line.splitlines()
+        if lst:
+            return lst[0]
+        return u''
+
+    # called by the key handler before the user changes the text, pos is
+    # the lowest position that may be changed
+    def touched(self, pos):
+        tail = self.body.len() - pos
+        if self.low is None or pos < self.low:
+            self.low = pos
+        if self.tail is None or tail < self.tail:
+            self.tail = tail
+
+    # checks if the text changed behind our back and repairs the table
+    # if needed, pos is the current caret position; returns the offset
+    # of the first line that could change or None if the text is unchanged
+    def sync(self, pos):
+        delta = self.body.len() - self.length
+        if self.low is not None:
+            # the key inserted or deleted one character at the touched
+            # position and could replace a selection next to it; the range
+            # is extended by the length of such selection
+            k = max(1 - delta, 0)
+            a = max(self.low - k, 0)
+            b = self.length - self.tail + k
+            self.low = self.tail = None
+            first = self.repair(a, min(max(a, b), self.length), delta)
+        elif delta:
+            # changed without a key press we know of (like a text pasted
+            # or entered by the FEP); such text goes in at the caret which
+            # may have moved since, so the lines between the old and the new
+            # caret are scanned; repair() rebuilds the table if the guess
+            # doesn't fit the text
+            k = abs(delta)
+            a = max(min(self.caret, pos, pos - delta) - k, 0)
+            b = max(self.caret, pos, pos - delta) + k
+            first = self.repair(a, min(b, self.length), delta)
+            self.sync_tail = None
+        else:
+            first = self.verify()
+        self.caret = pos
+        if first is not None or self.line is None or \
+                self.starts[self.index(pos)] != self.line[0]:
+            self.remember(pos)
+        return first
+
+    # remembers the line containing pos and the next one (the caret is
+    # often at the end of a line), so that a change of these lines which
+    # doesn't change the length of the text (like a text pasted over
+    # a selection of the same length) can be found by verify()
+    def remember(self, pos):
+        i = self.index(pos)
+        beg = self.starts[i]
+        end = self.get_bounds(min(i + 1, len(self.starts) - 1))[1]
+        self.line = (beg, self.body.get(beg, end - beg))
+
+    # compares the remembered lines with the text and repairs the table
+    # if they changed; returns the offset of the first line that could
+    # change or None if the lines are unchanged
+    def verify(self):
+        if self.line is None:
+            return None
+        beg, text = self.line
+        if self.body.get(beg, len(text)) == text:
+            return None
+        first = self.repair(beg, beg + len(text), 0)
+        self.sync_tail = None
+        return first
+
+    # rescans the lines of the old text between a and b positions,
+    # delta is the change of the text length
+    def repair(self, a, b, delta):
+        starts = self.starts
+        i = self.index(a)
+        j = self.index(b) + 1
+        beg = starts[i]
+        length = self.length + delta
+        if j < len(starts):
+            end = starts[j] + delta
+        else:
+            end = length
+        if beg <= end <= length and self.is_line_start(beg):
+            chunk = self.body.get(beg, end - beg)
+            if j == len(starts) or self.is_break(chunk[-1:]):
+                # the lines around the range must still start after
+                # a line break, otherwise the text changed elsewhere
+                k = self.check_lines
+                ok = True
+                for x in starts[max(i - k, 1):i] + \
+                        [x + delta for x in starts[j+1:j+1+k]]:
+                    if not self.is_line_start(x):
+                        ok = False
+                        break
+                if ok:
+                    starts[i+1:] = self.scan(chunk, beg) + \
+                        [x + delta for x in starts[j+1:]]
+                    self.length = length
+                    self.sync_tail = length - end
+                    return beg
+        # the change wasn't where we expected it, rebuild everything
+        self.reset(self.body.get())
+        return 0
+
+    def is_break(self, c):
+        return c != u'' and c.splitlines() != [c]
+
+    def is_line_start(self, pos):
+        return pos == 0 or self.is_break(self.body.get(pos - 1, 1))
+
+    # called after text was inserted into the control at pos
+    def inserted(self, pos, text):
+        self.line = None
+        i = self.index(pos)
+        n = len(text)
+        self.starts[i+1:] = self.scan(text, pos) + \
+            [x + n for x in self.starts[i+1:]]
+        self.length += n
+
+    # called after length chars were deleted from the control at pos
+    def deleted(self, pos, length):
+        self.line = None
+        i = bisect_right(self.starts, pos)
+        j = bisect_right(self.starts, pos + length)
+        self.starts[i:] = [x - length for x in self.starts[j:]]
+        self.length -= length
+
+    def __len__(self):
+        return len(self.starts)
+
+    # returns the index of the line containing pos
+    def index(self, pos):
+        return max(bisect_right(self.starts, pos) - 1, 0)
+
+    # returns the offsets of the start and the end (after the line break)
+    # of the line with given index
+    def get_bounds(self, i):
+        try:
+            return self.starts[i], self.starts[i+1]
+        except IndexError:
+            return self.starts[i], self.length
+
+    # returns the (offset, string) tuple of the line with given index
+    def get_line(self, i):
+        beg, end = self.get_bounds(i)
+        return beg, self.strip(self.body.get(beg, end - beg))
+
+
+# finds the matches of a pattern in the text of a TextWindow; the text
+# (lowercased for case-insensitive searches) and the offsets of all matches
+# are cached until the revision of the text or the pattern changes, so
+# repeated searches only do a binary search in the list of matches; if
+# window is None, only iter_text_matches() can be used
+class TextSearch(object):
+    def __init__(self, window=None):
+        self.window = window
+        self.text = None
+        self.text_key = None
+        self.options = None
+        self.set_pattern(u'')
+
+    # sets the pattern and the search options; if regex is True, pattern
+    # is a regular expression and re.error is raised if it is invalid
+    def set_pattern(self, pattern, case=False, words=False, regex=False):
+        options = (pattern, case, words, regex)
+        if options == self.options:
+            return
+        if regex or words:
+            import re
+            if not regex:
+                pattern = re.escape(pattern)
+            if words:
+                pattern = r'\b(?:%s)\b' % pattern
+            flags = re.UNICODE | re.MULTILINE
+            if not case:
+                flags |= re.IGNORECASE
+            self.regex = re.compile(pattern, flags)
+        else:
+            self.regex = None
+            if not case:
+                pattern = pattern.lower()
+        self.pattern = pattern
+        self.case = case
+        self.options = options
+        self.matches_revision = None
+        self.starts = []
+        self.ends = []
+
+    # sets the pattern using the find options from settings; returns False
+    # (after informing the user) if the pattern is invalid
+    def set_find_text(self, find_text):
+        import re
+        try:
+            self.set_pattern(find_text,
+                case=app.settings.text.findcase,
+                words=app.settings.text.findwords,
+                regex=app.settings.text.findregex)
+        except re.error:
+            ui.note(_('Invalid regular expression'), 'error')
+            return False
+        return True
+
+    # returns the text of the window normalized for searching, see
+    # normalize()
+    def get_text(self):
+        key = (self.window.get_revision(), self.regex is None and not self.case)
+        if key != self.text_key:
+            # release the old text first
+            self.text = None
+            self.text = self.normalize(self.window.body.get())
+            self.text_key = key
+        return self.text
+
+    # returns the text with line breaks converted to '\n' (so the regular
+    # expressions can use them) and lowercased for case-insensitive plain
+    # text searches; the offsets in the text are not changed
+    def normalize(self, text):
+        text = text.translate({0x2028: 10, 0x2029: 10})
+        if self.regex is None and not self.case:
+            text = text.lower()
+        return text
+
+    # generator yielding the matches as (start, end) tuples; the text is
+    # searched lazily, the offsets are cached once all matches are found
+    def iter_matches(self):
+        revision = self.window.get_revision()
+        options = self.options
+        if revision == self.matches_revision:
+            for i in xrange(len(self.starts)):
+                yield self.starts[i], self.ends[i]
+            return
+        starts = []
+        ends = []
+        for start, end in self.iter_text_matches(self.get_text()):
+            starts.append(start)
+            ends.append(end)
+            yield start, end
+        if self.window.get_revision() == revision and self.options == options:
+            self.starts = starts
+            self.ends = ends
+            self.matches_revision = revision
+
+    # generator yielding the matches in text as (start, end) tuples; text
+    # must be normalized, see get_text()
+    def iter_text_matches(self, text):
+        if self.regex is not None:
+            for m in self.regex.finditer(text):
+                # skip empty matches
+                if m.end() > m.start():
+                    yield m.start(), m.end()
+        elif self.pattern:
+            pattern = self.pattern
+            i = text.find(pattern)
+            while i >= 0:
+                yield i, i + len(pattern)
+                i = text.find(pattern, i + len(pattern))
+
+    # returns the replacement of the match starting at start in ntext
+    # (normalized text); for regular expressions, replacement may refer
+    # to the groups (like \1) and re.error is raised if it is invalid;
+    # otherwise it is used as is (even if a regex is used to match whole
+    # words)
+    def expand(self, ntext, start, replacement):
+        if not self.options[3]:
+            return replacement
+        m = self.regex.match(ntext, start)
+        return m.expand(replacement).translate({10: 0x2029})
+
+    # replaces the matches (sequence of (start, end) tuples, all by default)
+    # building the new text in one pass; ntext is the normalized text if
+    # already known; returns a (text, count, pos) tuple where pos is the
+    # offset in the new text following the last replacement
+    def replace(self, text, replacement, matches=None, ntext=None):
+        if ntext is None:
+            ntext = self.normalize(text)
+        if matches is None:
+            matches = self.iter_text_matches(ntext)
+        pieces = []
+        last = pos = count = 0
+        for start, end in matches:
+            pieces.append(text[last:start])
+            pieces.append(self.expand(ntext, start, replacement))
+            pos += start - last + len(pieces[-1])
+            last = end
+            count += 1
+        pieces.append(text[last:])
+        return u''.join(pieces), count, pos
+
+    # returns the (starts, ends) tuple of lists of the offsets of matches
+    def get_matches(self):
+        if self.window.get_revision() != self.matches_revision:
+            for match in self.iter_matches():
+                pass
+        return self.starts, self.ends
+
+    # returns the (start, end) tuple of the first match starting at pos
+    # or later (excluding the one at pos if skip is True) or None
+    def find(self, pos, skip=False):
+        starts, ends = self.get_matches()
+        i = bisect_left(starts, pos)
+        if skip and i < len(starts) and starts[i] == pos:
+            i += 1
+        if i < len(starts):
+            return starts[i], ends[i]
+        return None
+
+
 class TextWindow(Window):
+    # keys changing the text, used to track the changes made by the user
+    edit_keys = tuple(range(32, 128)) + (ui.EKeyBackspace, ui.EKeyEnter)
+
     def __init__(self, **kwargs):
         Window.__init__(self, **kwargs)
         self.body = ui.Text()
+        self.line_table = LineTable(self.body)
+        self.revision = 0
+        self.observers = []
+        self.text_search = TextSearch(self)
         self.find_text = u''
+        self.replace_text = u''
+        self.keys += self.edit_keys
         self.keys += (ui.EKeyEnter, ui.EKeySelect, ui.EKeyHome)
         self.control_keys += (ui.EKeyLeftArrow, ui.EKeyRightArrow,
                               ui.EKeyUpArrow, ui.EKeyDownArrow, ui.EKeyEdit)
@@ -328,6 +704,10 @@ class TextWindow(Window):
         edit_menu.append(ui.MenuItem(_('Find...'), target=self.find_click))
         edit_menu.append(ui.MenuItem(_('Find Next'), target=self.findnext_click))
         edit_menu.append(ui.MenuItem(_('Find All...'), target=self.findall_click))
+        edit_menu.append(ui.MenuItem(_('Find in Files...'), target=self.findinfiles_click))
+        edit_menu.append(ui.MenuItem(_('Replace...'), target=self.replace_click))
+        edit_menu.append(ui.MenuItem(_('Replace All...'), target=self.replaceall_click))
+        edit_menu.append(ui.MenuItem(_('Replace in Files...'), target=self.replaceinfiles_click))
         edit_menu.append(ui.MenuItem(_('Go to Line...'), target=self.gotoline_click))
         edit_menu.append(ui.MenuItem(_('Top'), target=self.move_beg_of_document))
         edit_menu.append(ui.MenuItem(_('Bottom'), target=self.move_end_of_document))
@@ -351,8 +731,17 @@ class TextWindow(Window):
         pass
 
     def key_press(self, key):
+        if key in self.edit_keys:
+            # we're called before the control handles the key; the
+            # previous changes are synchronized first, so only the change
+            # made by this key is left for the next sync()
+            self.get_line_table()
+            self.line_table.touched(max(self.body.get_pos() - 1, 0))
+            # the change is reported (see text_changed()) when the table
+            # is synchronized after the key is processed
+            ui.schedule(self.get_line_table)
         if key == ui.EKeySelect:
-            self.body.add(u'\n')
+            self.add_text(u'\n')
             ui.schedule(self.enter_key_press)
         elif key == ui.EKeyEnter:
             ui.schedule(self.enter_key_press)
@@ -387,6 +776,10 @@ class TextWindow(Window):
         menu.append(ui.MenuItem(_('Find...'), method=cls.find_click))
         menu.append(ui.MenuItem(_('Find Next'), method=cls.findnext_click))
         menu.append(ui.MenuItem(_('Find All...'), method=cls.findall_click))
+        menu.append(ui.MenuItem(_('Find in Files...'), method=cls.findinfiles_click))
+        menu.append(ui.MenuItem(_('Replace...'), method=cls.replace_click))
+        menu.append(ui.MenuItem(_('Replace All...'), method=cls.replaceall_click))
+        menu.append(ui.MenuItem(_('Replace in Files...'), method=cls.replaceinfiles_click))
         menu.append(ui.MenuItem(_('Go to Line...'), method=cls.gotoline_click))
         menu.append(ui.MenuItem(_('Top'), method=cls.move_beg_of_document))
         menu.append(ui.MenuItem(_('Bottom'), method=cls.move_end_of_document))
@@ -458,83 +851,167 @@ class TextWindow(Window):
             else:
                 self.set_shortcut(key, None)
 
+    # returns the line table synchronized with the text control
+    def get_line_table(self):
+        table = self.line_table
+        pos = table.sync(self.body.get_pos())
+        if pos is not None:
+            self.text_changed(pos, table.sync_tail)
+        return table
+
+    # returns the revision number of the text; the number is increased
+    # every time the text changes so it can be used to validate caches
+    def get_revision(self):
+        self.get_line_table()
+        return self.revision
+
+    # observers are called as observer(window, pos) after every change
+    # of the text, pos is the lowest offset that may have changed; the
+    # changes made by the user in the control are reported once they are
+    # found by get_line_table(), which is done after every edit key
+    def add_observer(self, observer):
+        if observer not in self.observers:
+            self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        try:
+            self.observers.remove(observer)
+        except ValueError:
+            pass
+
+    # called when the text changes, pos is the lowest offset that may have
+    # changed and tail is the length of the end of the text which is known
+    # to be unchanged
+    def text_changed(self, pos=0, tail=0):
+        self.revision += 1
+        for observer in list(self.observers):
+            observer(self, pos)
+
     # returns all lines as list of (number, offset, string) tuples;
     # line numbers are counted from 1, offset is counted from start of text,
     # string is unicode
     def get_lines(self):
+        table = self.get_line_table()
+        text = self.body.get()
+        starts = table.starts + [len(text)]
         lines = []
-        pos = 0
-        n = 1
-        lst = self.body.get().splitlines()
-        if not lst:
-            lst.append(u'')
-        for line in lst:
-            lines.append((n, pos, line))
-            n += 1
-            pos += len(line) + 1
+        for i in xrange(len(table)):
+            lines.append((i + 1, starts[i], table.strip(text[starts[i]:starts[i+1]])))
         return lines
 
+    # returns the number of lines
+    def get_line_count(self):
+        return len(self.get_line_table())
+
+    # returns a line based on given number (counted from 1); a line is
+    # a tuple as returned by get_lines(); raises IndexError if there is
+    # no such line
+    def get_line(self, n):
+        table = self.get_line_table()
+        if not 1 <= n <= len(table):
+            raise IndexError('line number out of range')
+        return (n,) + table.get_line(n - 1)
+
     # returns a line based on given pos (offset); a line is a tuple
     # as returned by get_lines()
     def get_line_from_pos(self, pos=None, lines=None):
         if pos is None:
             pos = self.body.get_pos()
-        if lines is None:
-            lines = self.get_lines()
-        for ln, lpos, line in lines:
-            if lpos <= pos <= lpos+len(line):
-                break
-        return (ln, lpos, line)
+        if lines is not None:
+            i = max(bisect_right([x[1] for x in lines], pos) - 1, 0)
+            return lines[i]
+        table = self.get_line_table()
+        i = table.index(pos)
+        return (i + 1,) + table.get_line(i)
+
+    # returns a part of the text around pos (caret by default) as a
+    # (text, pos) tuple where pos is made relative to the returned text;
+    # the text contains the line with pos and up to 'before' and 'after'
+    # lines above and below it; use this instead of body.get() if only
+    # the neighbourhood of the caret is needed
+    def get_text_window(self, pos=None, before=0, after=0):
+        if pos is None:
+            pos = self.body.get_pos()
+        table = self.get_line_table()
+        i = table.index(pos)
+        beg = table.starts[max(i - before, 0)]
+        try:
+            end = table.starts[i + after + 1]
+        except IndexError:
+            end = table.length
+        return self.body.get(beg, end - beg), pos - beg
+
+    # use these instead of body.add(), body.delete() and body.set()
+    # to keep the line table up to date
+    def add_text(self, text):
+        table = self.get_line_table()
+        pos = self.body.get_pos()
+        self.body.add(text)
+        table.inserted(pos, text)
+        self.text_changed(pos, table.length - pos - len(text))
+
+    def delete_text(self, pos=0, length=None):
+        table = self.get_line_table()
+        if length is None or pos + length > table.length:
+            length = table.length - pos
+        self.body.delete(pos, length)
+        table.deleted(pos, length)
+        self.text_changed(pos, table.length - pos)
+
+    def set_text(self, text):
+        self.body.set(text)
+        self.line_table.reset(text)
+        self.text_changed(0)
+
+    # sets the pattern of the search engine using the find options from
+    # settings, returns False if the pattern is invalid
+    def set_find_text(self, find_text):
+        if not self.text_search.set_find_text(find_text):
+            return False
+        self.find_text = find_text
+        return True
 
     def find_click(self):
         find_text = ui.query(_('Find:'), 'text', self.find_text)
-        if find_text:
-            self.find_text = find_text
+        if find_text and self.set_find_text(find_text):
             self.findnext_click(False)
         self.reset_control_key()
 
     def findnext_click(self, skip=True):
-        find_text = self.find_text.lower()
-        if not find_text:
+        if not self.find_text:
             self.find_click()
             return
-        text = self.body.get().lower()
-        i = self.body.get_pos()
-        while True:
-            pos = i
-            if skip and text[i:i+len(find_text)] == find_text:
-                i += len(find_text)
-            i = text.find(find_text, i)
-            if i >= 0:
-                self.body.set_pos(i)
-            else:
-                if pos != 0:
-                    if ui.query(_('Not found, start from beginning?'), 'query'):
-                        i = 0
-                        skip = False
-                        continue
-                else:
-                    ui.note(_('Not found'))
-            break
+        if self.set_find_text(self.find_text):
+            pos = self.body.get_pos()
+            match = self.text_search.find(pos, skip)
+            if match is None and pos != 0:
+                if ui.query(_('Not found, start from beginning?'), 'query'):
+                    match = self.text_search.find(0)
+                    if match is None:
+                        ui.note(_('Not found'))
+            elif match is None:
+                ui.note(_('Not found'))
+            if match is not None:
+                self.body.set_pos(match[0])
         self.reset_control_key()
 
+    # generator yielding the Find All results as (line number, line offset,
+    # line, column) tuples, see get_lines()
+    def iter_find_results(self):
+        last = None
+        for start, end in self.text_search.iter_matches():
+            table = self.get_line_table()
+            i = table.index(start)
+            if last is None or last[0] != i + 1:
+                last = self.get_line(i + 1)
+            yield last + (start - last[1],)
+
     def findall_click(self):
         find_text = ui.query(_('Find All:'), 'text', self.find_text)
-        if find_text:
-            self.find_text = find_text
-            find_text = find_text.lower()
-            results = []
-            for ln, lpos, line in self.get_lines():
-                pos = 0
-                while 1:
-                    pos = line.lower().find(find_text, pos)
-                    if pos < 0:
-                        break
-                    results.append((ln, lpos, line, pos))
-                    pos += len(find_text)
-            if results:
-                win = FindResultsWindow(title=_('Find: %s') % find_text,
-                    results=results)
+        if find_text and self.set_find_text(find_text):
+            win = FindResultsWindow(title=_('Find: %s') % find_text,
+                results=self.iter_find_results())
+            if win.results:
                 line = win.modal(self)
                 if line:
                     self.body.set_pos(line[1] + line[3])
@@ -542,16 +1019,101 @@ class TextWindow(Window):
                 ui.note(_('Not found'))
         self.reset_control_key()
 
+    def findinfiles_click(self):
+        path = getattr(self, 'path', None)
+        if path:
+            path = os.path.split(path)[0]
+        app.findinfiles(path, self.find_text)
+        self.reset_control_key()
+
+    # asks for the text to find and its replacement; returns False if
+    # cancelled or if the pattern is invalid
+    def ask_replace(self, title):
+        find_text = ui.query(title, 'text', self.find_text)
+        if not find_text or not self.set_find_text(find_text):
+            return False
+        replace_text = ui.query(_('Replace with:'), 'text', self.replace_text)
+        if replace_text is None:
+            return False
+        self.replace_text = replace_text
+        return True
+
+    # replaces the matches (sequence of (start, end) tuples, all by default)
+    # of the current search pattern; the text is set at once and the caret
+    # is moved after the last replacement; returns the number of
+    # replaced matches
+    def replace_matches(self, matches=None):
+        import re
+        search = self.text_search
+        if matches is None:
+            matches = zip(*search.get_matches())
+        try:
+            text, count, pos = search.replace(self.body.get(),
+                self.replace_text, matches, search.get_text())
+        except re.error:
+            ui.note(_('Invalid replacement text'), 'error')
+            return 0
+        if count:
+            self.set_text(text)
+            self.body.set_pos(pos)
+        return count
+
+    def replace_click(self):
+        if self.ask_replace(_('Replace:')):
+            starts, ends = self.text_search.get_matches()
+            pos = self.body.get_pos()
+            i = bisect_left(starts, pos)
+            if not starts:
+                ui.note(_('Not found'))
+            elif i == len(starts) and pos != 0:
+                if ui.query(_('Not found, start from beginning?'), 'query'):
+                    i = 0
+            # let the user decide about every match, then replace them at once
+            menu = ui.Menu(_('Replace'))
+            menu.append(ui.MenuItem(_('Replace'), action=1))
+            menu.append(ui.MenuItem(_('Skip'), action=0))
+            menu.append(ui.MenuItem(_('Replace All'), action=2))
+            matches = []
+            while i < len(starts):
+                self.body.set_pos(starts[i])
+                item = menu.popup()
+                if item is None:
+                    break
+                if item.action == 2:
+                    matches.extend(zip(starts[i:], ends[i:]))
+                    break
+                if item.action == 1:
+                    matches.append((starts[i], ends[i]))
+                i += 1
+            if matches:
+                self.replace_matches(matches)
+        self.reset_control_key()
+
+    def replaceall_click(self):
+        if self.ask_replace(_('Replace All:')):
+            count = len(self.text_search.get_matches()[0])
+            if not count:
+                ui.note(_('Not found'))
+            elif ui.query(_('Replace %d occurrences?') % count, 'query'):
+                self.replace_matches()
+        self.reset_control_key()
+
+    def replaceinfiles_click(self):
+        path = getattr(self, 'path', None)
+        if path:
+            path = os.path.split(path)[0]
+        app.replaceinfiles(path, self.find_text, self.replace_text)
+        self.reset_control_key()
+
     def gotoline_click(self):
-        lines = self.get_lines()
-        ln = self.get_line_from_pos(lines=lines)[0]
-        ln = ui.query(_('Line (1-%d):') % len(lines), 'number', ln)
+        count = self.get_line_count()
+        ln = self.get_line_from_pos()[0]
+        ln = ui.query(_('Line (1-%d):') % count, 'number', ln)
         if ln is not None:
             if ln < 1:
                 ln = 1
-            ln -= 1
             try:
-                self.body.set_pos(lines[ln][1])
+                self.body.set_pos(self.get_line(ln)[1])
             except IndexError:
                 self.body.set_pos(self.body.len())
         self.reset_control_key()
@@ -604,28 +1166,26 @@ class TextWindow(Window):
         self.move_line_down(count=self.get_pagesize())
 
     def move_line_up(self, count=1):
-        lines = self.get_lines()
-        pos = self.body.get_pos()
-        ln, lpos, line = self.get_line_from_pos(lines=lines, pos=pos)
-        i = ln-1-count
-        if i < 0:
-            i = 0
-        lpos = pos-lpos
-        if lpos > len(lines[i][2]):
-            lpos = len(lines[i][2])
-        self.set_pos(lines[i][1]+lpos)
+        self.move_line(-count)
 
     def move_line_down(self, count=1):
-        lines = self.get_lines()
+        self.move_line(count)
+
+    # moves the caret by count lines keeping the column if possible
+    def move_line(self, count):
+        table = self.get_line_table()
         pos = self.body.get_pos()
-        ln, lpos, line = self.get_line_from_pos(lines=lines, pos=pos)
-        i = ln-1+count
-        if i >= len(lines):
-            i = -1
-        lpos = pos-lpos
-        if lpos > len(lines[i][2]):
-            lpos = len(lines[i][2])
-        self.set_pos(lines[i][1]+lpos)
+        i = table.index(pos)
+        lpos = pos - table.starts[i]
+        i += count
+        if i < 0:
+            i = 0
+        elif i >= len(table):
+            i = len(table) - 1
+        offset, line = table.get_line(i)
+        if lpos > len(line):
+            lpos = len(line)
+        self.set_pos(offset + lpos)
 
     def move_beg_of_document(self):
         self.set_pos(0)
@@ -647,27 +1207,152 @@ class TextWindow(Window):
 
 
 class FindResultsWindow(Window):
+    # number of results fetched at once
+    page_size = 30
+
     def __init__(self, **kwargs):
-        self.results = pop(kwargs, 'results')
+        # results may be a list or an iterator yielding them lazily; only
+        # the results the user scrolled to are fetched and formatted
+        self.results_iter = iter(pop(kwargs, 'results'))
         kwargs.setdefault('title', _('Find All'))
         Window.__init__(self, **kwargs)
-        self.body = ui.Listbox([(_('Line %d, Column %d') % (x[0], x[3]), x[2]) for x in self.results], self.select_click)
+        self.results = []
+        self.items = []
+        self.fetch_results()
+        self.body = ui.Listbox(self.get_items(), self.select_click)
+        self.keys += (ui.EKeyDownArrow,)
         self.menu = ui.Menu()
         self.menu.append(ui.MenuItem(_('Select'), target=self.select_click))
         self.menu.append(ui.MenuItem(_('Exit'), target=self.close))
 
+    # returns the listbox item of a result
+    def format_result(self, x):
+        return (_('Line %d, Column %d') % (x[0], x[3]), x[2])
+
+    # returns the listbox item displayed at the end of the list until all
+    # results are fetched
+    def get_more_item(self):
+        return (_('More results...'), u'')
+
+    # returns the list of listbox items
+    def get_items(self):
+        if not self.items:
+            return [(_('Not found'), u'')]
+        return self.items
+
+    # fetches the next page of results; the iterator may yield None to
+    # end the page early and let the event loop run
+    def fetch_results(self):
+        if self.results_iter is None:
+            return
+        if len(self.items) > len(self.results):
+            del self.items[-1]
+        first = len(self.results)
+        count = self.page_size
+        while count > 0:
+            try:
+                x = self.results_iter.next()
+            except StopIteration:
+                self.results_iter = None
+                break
+            if x is None:
+                break
+            self.results.append(x)
+            self.items.append(self.format_result(x))
+            count -= 1
+        if self.results_iter is not None:
+            self.items.append(self.get_more_item())
+        # the listbox is updated only if there are new results or all
+        # were fetched, not on every None yielded by the iterator
+        if self.body is not None and (len(self.results) > first or
+                self.results_iter is None):
+            items = self.get_items()
+            self.body.set_list(items, min(self.body.current(), len(items) - 1))
+
+    def key_press(self, key):
+        if key == ui.EKeyDownArrow:
+            # the key is processed by the listbox after we return so the
+            # next page is fetched when the user approaches the end
+            if self.results_iter is not None and \
+                    self.body.current() >= len(self.results) - 2:
+                ui.schedule(self.fetch_results)
+        else:
+            Window.key_press(self, key)
+
     def select_click(self):
-        self.modal_result = self.results[self.body.current()]
+        i = self.body.current()
+        if i >= len(self.results):
+            self.fetch_results()
+            return
+        self.modal_result = self.results[i]
         self.close()
 
 
+# shows the Find in Files results while the files are being searched;
+# results are (path, line number, column, line) tuples
+class FindInFilesWindow(FindResultsWindow):
+    def __init__(self, **kwargs):
+        kwargs.setdefault('title', _('Find in Files'))
+        FindResultsWindow.__init__(self, **kwargs)
+        ui.schedule(self.search)
+
+    def format_result(self, x):
+        if isinstance(x[0], Window):
+            name = x[0].title
+        else:
+            name = os.path.split(x[0])[1].decode('utf8')
+        return (u'%s:%d' % (name, x[1]), x[3])
+
+    def get_more_item(self):
+        return (_('Searching...'), u'')
+
+    # searches the files in chunks, letting the event loop run in between
+    def search(self):
+        if self.is_closed() or self.results_iter is None:
+            return
+        self.fetch_results()
+        if self.results_iter is not None:
+            ui.schedule(self.search)
+
+    def key_press(self, key):
+        # results are fetched by search(), not when scrolling
+        Window.key_press(self, key)
+
+    def select_click(self):
+        i = self.body.current()
+        if i >= len(self.results):
+            return
+        path, ln, col, line = self.results[i]
+        if isinstance(path, Window):
+            win = path
+            if win.is_closed():
+                return
+            win.focus = True
+        else:
+            win = app.load_file(path)
+        if win:
+            try:
+                win.body.set_pos(win.get_line(ln)[1] + col)
+            except IndexError:
+                pass
+
+    def close(self):
+        self.results_iter = None
+        return FindResultsWindow.close(self)
+
+
 class TextFileWindow(TextWindow):
     type_name = 'Text'
     type_ext = '.txt'
+    # size of the chunks in which files are read and hashed
+    chunk_size = 32768
     session = ui.SettingsGroup()
     session.append('windows', ui.Setting('', []))
 
     def __init__(self, **kwargs):
+        # state of the last saved or loaded text, see is_modified()
+        self.saved_hash = self.saved_stat = None
+        self.journal = BufferJournal(self)
         try:
             self.path = pop(kwargs, 'path')
         except KeyError:
@@ -676,13 +1361,16 @@ class TextFileWindow(TextWindow):
             self.encoding = 'latin1'
             TextWindow.__init__(self, **kwargs)
         else:
+            stat = self.get_file_stat()
             text, self.encoding = self.load()
             self.fixed_encoding = True
             TextWindow.__init__(self, **kwargs)
-            self.body.set(text)
+            self.set_text(text)
             self.body.set_pos(0)
             self.title = os.path.split(self.path)[1].decode('utf8')
-        self.autosave_timer = e32.Ao_timer()
+            self.set_saved(self.text_hash(text), stat)
+        self.add_observer(app.autosave.text_changed)
+        app.recovery.start()
         file_menu = self.menu.find(title=_('File'))[0].submenu
         file_menu.append(ui.MenuItem(_('Save'), target=self.save))
         file_menu.append(ui.MenuItem(_('Save As...'), target=self.save_as))
@@ -695,26 +1383,14 @@ class TextFileWindow(TextWindow):
         try:
             if not self.fixed_encoding:
                 self.encoding = app.settings.file.encoding
-            autosave = app.settings.file.autosave
-            self.autosave_timer.cancel()
-            if autosave and self.path is not None:
-                self.autosave_timer.after(autosave, self.autosave)
         except AttributeError:
             pass
 
     def can_close(self):
         if not TextWindow.can_close(self):
             return False
-        text = self.body.get()
-        if self.path is None:
-            if not text:
-                return True
-        else:
-            try:
-                if text == self.load()[0]:
-                    return True
-            except IOError:
-                pass
+        if not self.is_modified():
+            return True
         menu = ui.Menu(_('Changes'))
         menu.append(ui.MenuItem(_('Save'), value=True))
         menu.append(ui.MenuItem(_('Discard'), value=False))
@@ -728,7 +1404,8 @@ class TextFileWindow(TextWindow):
 
     def close(self):
         if TextWindow.close(self):
-            self.autosave_timer.cancel()
+            app.autosave.remove_window(self)
+            self.journal.remove()
             return True
         return False
 
@@ -751,48 +1428,173 @@ class TextFileWindow(TextWindow):
             return True
         return False
 
+    # returns the md5 digest of the text encoded in UTF-8; the text is
+    # encoded in slices to avoid a copy of the whole text (surrogate pairs
+    # are kept together, like in write_text())
+    def text_hash(cls, text):
+        h = md5()
+        size = cls.chunk_size
+        length = len(text)
+        pos = 0
+        while pos < length:
+            n = min(size, length - pos)
+            if pos + n < length and 0xd800 <= ord(text[pos+n-1]) < 0xdc00:
+                n -= 1
+            h.update(text[pos:pos+n].encode('utf8'))
+            pos += n
+        return h.digest()
+    text_hash = classmethod(text_hash)
+
+    # returns the (mtime, size) of the file or None if it cannot be accessed
+    def get_file_stat(self):
+        try:
+            st = os.stat(self.path)
+        except (OSError, TypeError):
+            return None
+        return (st.st_mtime, st.st_size)
+
+    # remembers the state of the text which is now the same as in the file,
+    # texthash is the text_hash() of the text, stat is the get_file_stat()
+    # of the file taken before it was read or after it was written
+    def set_saved(self, texthash, stat):
+        self.saved_hash = texthash
+        self.saved_stat = stat
+        self.journal.saved(texthash)
+
+    def text_changed(self, pos=0, tail=0):
+        TextWindow.text_changed(self, pos, tail)
+        self.journal.changed(pos, tail)
+
+    # returns True if the text differs from the file; instead of reading
+    # the file, the hash of the text is compared with the one of the last
+    # load/save and the file is checked for changes using its modification
+    # time and size; the revision isn't used as the user can change the
+    # text without changing its length, which get_line_table() may miss
+    def is_modified(self):
+        if self.path is None:
+            # new file, changed if not empty
+            return self.body.len() > 0
+        if self.saved_hash is None or self.get_file_stat() != self.saved_stat:
+            return True
+        return self.text_hash(self.body.get()) != self.saved_hash
+
     def load(self):
         if self.path is None:
             raise IOError('TextFileWindow: no path specified')
-        f = file(self.path, 'r')
-        text = f.read()
-        f.close()
-        if text.startswith('\xff\xfe') or text.startswith('\xfe\xff'):
-            enc = 'utf16'
-            text = text.decode(enc)
+        f = file(self.path, 'rb')
+        try:
+            return self.read_file(f)
+        finally:
+            f.close()
+
+    # reads and decodes a text file; returns a (text, encoding) tuple where
+    # text uses the line breaks of the Text control; UTF-16 is detected by
+    # the BOM, otherwise UTF-8 is validated while decoding and if the file
+    # turns out not to be UTF-8, it is read again as Latin-1; the file is
+    # read, decoded and its line breaks are converted in chunks, so only
+    # the decoded chunks and the final text are kept in memory
+    def read_file(cls, f):
+        chunk = f.read(cls.chunk_size)
+        rest = ''
+        if chunk.startswith('\xff\xfe'):
+            enc, codec = 'utf16', 'utf-16-le'
+        elif chunk.startswith('\xfe\xff'):
+            enc, codec = 'utf16', 'utf-16-be'
         else:
-            for enc in ['utf8', 'latin1']:
-                try:
-                    text = text.decode(enc)
-                    break
-                except UnicodeError:
-                    pass
+            enc = codec = 'utf8'
+        if enc == 'utf16':
+            # skip the BOM
+            rest = chunk[2:]
+            chunk = f.read(cls.chunk_size)
+        breaks = {13: None, 10: 0x2029}
+        pieces = []
+        while True:
+            data = rest + chunk
+            if chunk:
+                n = cls.get_chunk_end(data, codec)
             else:
-                raise UnicodeError
-        return text.translate({13: None, 10: 0x2029}), enc
+                n = len(data)
+            try:
+                pieces.append(data[:n].decode(codec).translate(breaks))
+            except UnicodeError:
+                if codec != 'utf8':
+                    raise
+                # not UTF-8, start again
+                enc = codec = 'latin1'
+                f.seek(0)
+                pieces = []
+                rest = ''
+                chunk = f.read(cls.chunk_size)
+                continue
+            if not chunk:
+                break
+            rest = data[n:]
+            chunk = f.read(cls.chunk_size)
+        return u''.join(pieces), enc
+    read_file = classmethod(read_file)
+
+    # returns the length of the part of a chunk of encoded data which can
+    # be decoded without the following chunk; an incomplete UTF-8 sequence
+    # or UTF-16 code unit or surrogate pair at the end is left out
+    def get_chunk_end(data, codec):
+        n = len(data)
+        if codec == 'utf8':
+            i = n - 1
+            while i >= max(n - 3, 0) and 0x80 <= ord(data[i]) < 0xc0:
+                i -= 1
+            if i < 0:
+                return n
+            c = ord(data[i])
+            if c >= 0xf0:
+                size = 4
+            elif c >= 0xe0:
+                size = 3
+            elif c >= 0xc0:
+                size = 2
+            else:
+                return n
+            if n - i < size:
+                return i
+            return n
+        if codec in ('utf-16-le', 'utf-16-be'):
+            n -= n % 2
+            if n >= 2:
+                if codec == 'utf-16-le':
+                    unit = ord(data[n-2]) | (ord(data[n-1]) << 8)
+                else:
+                    unit = (ord(data[n-2]) << 8) | ord(data[n-1])
+                if 0xd800 <= unit < 0xdc00:
+                    # high surrogate, the low one is in the next chunk
+                    n -= 2
+        return n
+    get_chunk_end = staticmethod(get_chunk_end)
+
+    # returns True if the contents of a file look like binary data
+    def is_binary(cls, text):
+        if text.startswith('\xff\xfe') or text.startswith('\xfe\xff'):
+            return False
+        return '\x00' in text[:1024]
+    is_binary = classmethod(is_binary)
 
-    def save(self):
+    # saves the text to the file, backups is the number of the backup
+    # copies to keep (the backups setting if None); the autosave passes 0,
+    # so only the explicit saves rotate the copies
+    def save(self, backups=None):
         if self.path is None:
             return self.save_as()
-        autosave = app.settings.file.autosave
-        self.autosave_timer.cancel()
-        if autosave:
-            self.autosave_timer.after(autosave, self.autosave)
-        try:
-            f = file(self.path, 'w')
-            f.write(self.body.get().translate({0x2028: 0x2029, 0xa0: 0x20}).replace(u'\u2029',
-                u'\r\n').encode(self.encoding))
-            f.close()
+        if backups is None:
+            backups = app.settings.file.backups
+        try:
+            texthash = md5()
+            def write(f):
+                write_text(f, self.body, self.encoding, texthash)
+            atomic_write(self.path, write, backups)
+            self.set_saved(texthash.digest(), self.get_file_stat())
             return True
-        except IOError:
+        except (IOError, OSError):
             ui.note(_('Cannot save file'), 'error')
             return False
 
-    def autosave(self):
-        if self.save():
-            if hasattr(ui, 'infopopup'):
-                ui.infopopup.show(_('File saved'))
-
     def save_as(self):
         path = self.path
         if path is None:
@@ -820,28 +1622,34 @@ class TextFileWindow(TextWindow):
 
     def save_all(self):
         for win in ui.screen.find_windows(TextFileWindow):
+            if win.path is not None and not win.is_modified():
+                continue
             if not win.save():
                 return
 
+    # stores the opened windows in the session file; the text of the
+    # modified windows is not stored, their recovery journals are flushed
+    # and the names of the journals are stored instead
     def store_session(cls):
         windows = cls.session.windows
         del windows[:]
         for win in ui.screen.find_windows(TextFileWindow):
-            try:
-                text = win.body.get()
-                encoding = win.encoding
-                if win.load()[0] == text:
-                    # file unchanged - no need to store the text
-                    text = None
-                else:
-                    raise IOError
-            except IOError:
-                pass
+            encoding = win.encoding
+            if win.path is not None and not win.is_modified():
+                # file unchanged - no need to recover the text
+                win.journal.remove()
+                journal = None
+            else:
+                try:
+                    win.journal.flush(True)
+                except (IOError, OSError):
+                    pass
+                journal = win.journal.filename
             if win.path:
                 path = win.path
             else:
                 path = win.title.encode('utf8')
-            windows.insert(0, (path, text, encoding, win.body.get_pos()))
+            windows.insert(0, (path, journal, encoding, win.body.get_pos()))
         cls.session.save()
     store_session = classmethod(store_session)
 
@@ -851,18 +1659,930 @@ class TextFileWindow(TextWindow):
     clear_session = classmethod(clear_session)
 
 
+# saves the modified files in the background (see the autosave setting);
+# the files changed since the last autosave are remembered and when the
+# autosave interval passes, they are saved one per idle slice, that is
+# after no key was pressed for idle_time seconds, so the saving doesn't
+# interrupt the typing; the whole batch is reported with one popup; the
+# timer runs every interval while the autosave is on, so the changes made
+# without a key press (FEP, paste) are found by polling the windows
+class AutosaveScheduler(object):
+    idle_time = 2.0
+
+    def __init__(self):
+        self.timer = e32.Ao_timer()
+        self.running = False
+        # windows changed since the last autosave
+        self.windows = []
+        self.last_change = 0.0
+        self.saved_count = 0
+
+    # observer of the TextFileWindows
+    def text_changed(self, win, pos):
+        self.last_change = time.time()
+        if win not in self.windows:
+            self.windows.append(win)
+        self.start()
+
+    def remove_window(self, win):
+        try:
+            self.windows.remove(win)
+        except ValueError:
+            pass
+
+    def start(self):
+        interval = app.settings.file.autosave
+        if self.running or not interval:
+            return
+        self.running = True
+        self.timer.after(interval, self.save_next)
+
+    # called when the settings change
+    def restart(self):
+        self.timer.cancel()
+        self.running = False
+        self.start()
+
+    # synchronizes the line tables of the open windows, the changes made
+    # in the controls behind our back are reported to text_changed()
+    def poll(self):
+        for win in ui.screen.find_windows(TextFileWindow):
+            win.get_line_table()
+
+    # saves the next window if there was no key press for idle_time
+    # seconds and schedules itself again until all windows are saved
+    def save_next(self):
+        self.poll()
+        idle = time.time() - self.last_change
+        if idle < self.idle_time:
+            self.timer.after(self.idle_time - idle, self.save_next)
+            return
+        while self.windows:
+            win = self.windows.pop(0)
+            if win.is_closed() or win.path is None or not win.is_modified():
+                continue
+            if win.save(0):
+                self.saved_count += 1
+            break
+        if self.windows:
+            self.timer.after(0, self.save_next)
+            return
+        self.running = False
+        if self.saved_count and hasattr(ui, 'infopopup'):
+            if self.saved_count == 1:
+                ui.infopopup.show(_('File saved'))
+            else:
+                ui.infopopup.show(_('%d files saved') % self.saved_count)
+        self.saved_count = 0
+        self.start()
+
+
+# crash recovery journal of a TextFileWindow; the changes of the text are
+# appended to a file in the recovery folder as marshalled records, the
+# first one is a (version, path, encoding) header followed by:
+#   ('text', text, pos) - snapshot of the whole text,
+#   ('file', hash) - the text is the contents of the file with given
+#     text_hash(), used if the file was loaded or saved before the changes,
+#   ('edit', low, tail, text, pos) - the text between the first low and
+#     the last tail characters was replaced with text;
+# pos is the caret position; the records are written by RecoveryJournal
+# when the user stops typing; the journal is removed when the text is
+# saved and rewritten as a single snapshot when it grows too large
+class BufferJournal(object):
+    version = 1
+    # size of the records after which the journal is compacted (or the
+    # length of the text, if it is larger)
+    compact_size = 65536
+
+    def __init__(self, window):
+        self.window = window
+        self.filename = None
+        # lowest changed position and shortest unchanged end of the text
+        # since the last flush() (see TextWindow.text_changed())
+        self.low = self.tail = None
+        # size of the records written since the last snapshot
+        self.size = 0
+        # text_hash() of the file if the text was loaded or saved and not
+        # written to the journal since then
+        self.base_hash = None
+
+    def changed(self, pos, tail):
+        if tail is None:
+            # the changed range is unknown
+            pos = tail = 0
+        if self.low is None or pos < self.low:
+            self.low = pos
+        if self.tail is None or tail < self.tail:
+            self.tail = tail
+        app.recovery.add(self)
+
+    # called when the text is loaded or saved
+    def saved(self, texthash):
+        self.remove()
+        self.base_hash = texthash
+
+    # removes the journal file, the changes are forgotten
+    def remove(self):
+        self.low = self.tail = None
+        app.recovery.discard(self)
+        if self.filename is not None:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+            self.filename = None
+
+    # continues a journal read by RecoveryJournal.read()
+    def adopt(self, filename):
+        self.remove()
+        self.base_hash = None
+        self.filename = filename
+        self.size = os.path.getsize(filename)
+
+    def get_header(self):
+        win = self.window
+        if win.path:
+            path = win.path
+        else:
+            path = win.title.encode('utf8')
+        return (self.version, path, win.encoding)
+
+    # writes the changes made since the last flush; if force is True, a
+    # snapshot is written even if there are no changes but no journal
+    def flush(self, force=False):
+        import marshal
+        body = self.window.body
+        # the changes made by the user are reported when the line table
+        # is synchronized with the text
+        self.window.get_line_table()
+        length = body.len()
+        if self.low is None:
+            if not force or self.filename is not None:
+                return
+            snapshot = True
+        else:
+            # the whole text is written if the changed range is unknown
+            # (the text was set or the line table only guessed it, see
+            # LineTable.sync()), so no edit is based on a guessed range
+            snapshot = (self.filename is None and self.base_hash is None) or \
+                (self.low == 0 and self.tail == 0) or \
+                self.size > max(self.compact_size, length)
+        if snapshot:
+            if self.filename is None:
+                self.filename = app.recovery.new_filename()
+            atomic_write(self.filename, marshal.dumps(self.get_header()) +
+                marshal.dumps(('text', body.get(), body.get_pos())))
+            self.size = 0
+        else:
+            if self.filename is None:
+                self.filename = app.recovery.new_filename()
+                data = marshal.dumps(self.get_header()) + \
+                    marshal.dumps(('file', self.base_hash))
+                mode = 'wb'
+            else:
+                data = ''
+                mode = 'ab'
+            low = min(self.low, length)
+            tail = min(self.tail, length - low)
+            data += marshal.dumps(('edit', low, tail,
+                body.get(low, length - tail - low), body.get_pos()))
+            f = file(self.filename, mode)
+            try:
+                f.write(data)
+                f.flush()
+            finally:
+                f.close()
+            self.size += len(data)
+        self.low = self.tail = None
+
+
+# writes the BufferJournals of the changed windows after the user stops
+# typing for idle_time seconds, one journal per idle slice; while there
+# are open TextFileWindows, they are polled every poll_time seconds for
+# the changes made without a key press (FEP, paste); also reads the
+# journals left by a previous run
+class RecoveryJournal(object):
+    idle_time = 2.0
+    poll_time = 10.0
+    ext = '.jnl'
+
+    def __init__(self, path):
+        self.path = path
+        self.timer = e32.Ao_timer()
+        self.running = False
+        self.journals = []
+        self.last_change = 0.0
+
+    def add(self, journal):
+        self.last_change = time.time()
+        if journal not in self.journals:
+            self.journals.append(journal)
+        self.start()
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.timer.after(self.idle_time, self.flush_next)
+
+    def discard(self, journal):
+        try:
+            self.journals.remove(journal)
+        except ValueError:
+            pass
+
+    def flush_next(self):
+        # synchronizing the line tables reports the changes made in the
+        # controls behind our back to the journals, which add() them
+        windows = ui.screen.find_windows(TextFileWindow)
+        for win in windows:
+            win.get_line_table()
+        idle = time.time() - self.last_change
+        if idle < self.idle_time:
+            self.timer.after(self.idle_time - idle, self.flush_next)
+            return
+        if self.journals:
+            journal = self.journals.pop(0)
+            try:
+                journal.flush()
+            except (IOError, OSError):
+                pass
+        if self.journals:
+            self.timer.after(0, self.flush_next)
+        elif windows:
+            self.timer.after(self.poll_time, self.flush_next)
+        else:
+            self.running = False
+
+    # returns the name of a new journal file
+    def new_filename(self):
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+        n = 1
+        while True:
+            filename = os.path.join(self.path, '%d%s' % (n, self.ext))
+            if not os.path.exists(filename):
+                return filename
+            n += 1
+
+    # returns the names of the existing journal files
+    def get_filenames(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return []
+        names = [os.path.join(self.path, x) for x in names if x.endswith(self.ext)]
+        names.sort()
+        return names
+
+    # removes all journal files
+    def clear(self):
+        for filename in self.get_filenames():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    # replays a journal; returns a (path, encoding, text, pos) tuple or
+    # None if the journal cannot be read or the file it is based on was
+    # changed; the records after a damaged one are ignored
+    def read(self, filename):
+        import marshal
+        try:
+            f = file(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                header = marshal.load(f)
+                if header[0] != BufferJournal.version:
+                    return None
+                path, encoding = header[1:]
+            except (EOFError, ValueError, TypeError, IndexError):
+                return None
+            text = None
+            pos = 0
+            while True:
+                try:
+                    record = marshal.load(f)
+                except (EOFError, ValueError, TypeError):
+                    break
+                if record[0] == 'text':
+                    text, pos = record[1:]
+                elif record[0] == 'file':
+                    try:
+                        data = app.read_text_file(path)
+                    except (IOError, OSError, UnicodeError):
+                        data = None
+                    if data is None or TextFileWindow.text_hash(data[0]) != record[1]:
+                        return None
+                    text = data[0]
+                elif record[0] == 'edit' and text is not None:
+                    low, tail, s, pos = record[1:]
+                    if low + tail > len(text):
+                        break
+                    text = text[:low] + s + text[len(text)-tail:]
+        finally:
+            f.close()
+        if text is None:
+            return None
+        return path, encoding, text, pos
+
+
 class AutocloseTextWindow(TextWindow):
     def focus_changed(self, focus):
         if not focus:
             self.close()
 
 
+# incremental tokenizer of the Python code in a TextWindow; the tokens of
+# every line and the tokenizer state at the start of every line are kept,
+# so after a change only the lines from the first changed one are scanned
+# again; the tokens are (col, kind, value) tuples with kind being one of
+# 'name', 'number', 'string', 'op'; comments and whitespace are skipped
+class PythonTokenizer(object):
+    # tokenizer state at the start of a line: (quote of an unterminated
+    # string or None, tuple of open brackets as (char, line, col) tuples,
+    # True if the previous line ends with a backslash)
+    initial_state = (None, (), False)
+    token_re = None
+    string_end_re = {}
+    brackets = {u')': u'(', u']': u'[', u'}': u'{'}
+    keywords = dict([(x, True) for x in u'and as assert break class continue def del elif else '
+        u'except exec finally for from global if import in is lambda not or pass print '
+        u'raise return try while with yield'.split()])
+
+    def __init__(self, window=None):
+        self.window = window
+        # per line lists
+        self.states = [self.initial_state]
+        self.tokens = []
+        self.indents = []
+        self.offsets = []
+        self.first = 0
+        self.outline = None
+        self.outline_revision = None
+        self.definitions = None
+        self.definitions_revision = None
+        self.names = None
+        self.names_revision = None
+        self.scopes = None
+        self.scopes_revision = None
+        if window is not None:
+            window.add_observer(self.text_changed)
+
+    def text_changed(self, window, pos):
+        if self.first is None or pos < self.first:
+            self.first = pos
+
+    # brings the tokens up to date with the text of the window; if end
+    # is given, only the lines before line end are updated
+    def update(self, end=None):
+        if self.window is None:
+            return
+        table = self.window.get_line_table()
+        if self.first is None:
+            return
+        n = min(table.index(self.first), len(self.tokens))
+        if end is None or end >= len(table):
+            end = len(table)
+            self.first = None
+        elif end <= n:
+            return
+        else:
+            # the rest is updated later
+            self.first = table.starts[end]
+        lines = []
+        if n < end:
+            starts = table.starts
+            offset = starts[n]
+            if end < len(table):
+                text = self.window.body.get(offset, starts[end] - offset)
+            else:
+                text = self.window.body.get(offset, self.window.body.len() - offset)
+            for i in xrange(n, end):
+                if i + 1 < len(table):
+                    line = text[starts[i]-offset:starts[i+1]-offset]
+                else:
+                    line = text[starts[i]-offset:]
+                lines.append((starts[i], table.strip(line)))
+        self.scan_lines(lines, n)
+
+    # returns the state at the start of line i; only the lines above it
+    # are tokenized if needed
+    def get_state(self, i):
+        self.update(i)
+        return self.states[i]
+
+    # returns the line where the logical line containing line i starts
+    def get_logical_start(self, i):
+        while i > 0 and self.indents[i] is None:
+            quote, brackets, cont = self.states[i]
+            if quote is None and not brackets and not cont:
+                break
+            i -= 1
+        return i
+
+    # returns the indentation width of line i (counted from 0) of given
+    # indentation size; it depends on the state at the start of the line:
+    # inside brackets it is aligned with the first item after the last
+    # open bracket or indented more than the line with the bracket if
+    # there is no such item; a new statement is indented more after
+    # a colon and less after return and similar statements; the
+    # indentation of the previous line (prev_line) is kept in strings
+    # and after blank lines
+    def get_indent(self, i, size, prev_line):
+        quote, brackets, cont = self.get_state(i)
+        keep = len(prev_line) - len(prev_line.lstrip())
+        if quote is not None:
+            return keep
+        if brackets:
+            char, line, col = brackets[-1]
+            for x in self.tokens[line]:
+                if x[0] > col:
+                    return x[0]
+            indent = self.indents[self.get_logical_start(line)]
+            if indent is None:
+                return keep
+            return indent + size
+        start = self.get_logical_start(i - 1)
+        indent = self.indents[start]
+        if indent is None or not self.tokens[i-1]:
+            return keep
+        if cont:
+            if start == i - 1:
+                return indent + size
+            return keep
+        if self.tokens[i-1][-1][2] == u':':
+            return indent + size
+        if self.tokens[start][0][2] in (u'return', u'pass', u'break', u'continue', u'raise'):
+            return max(indent - size, 0)
+        return indent
+
+    # replaces the lines starting from line n with lines given as
+    # (offset, text) tuples and tokenizes them
+    def scan_lines(self, lines, n=0):
+        del self.states[n+1:]
+        del self.tokens[n:]
+        del self.indents[n:]
+        del self.offsets[n:]
+        state = self.states[n]
+        for offset, line in lines:
+            tokens, indent, state = self.scan_line(line, state, n)
+            self.tokens.append(tokens)
+            self.indents.append(indent)
+            self.offsets.append(offset)
+            self.states.append(state)
+            n += 1
+
+    # tokenizes one line of code starting in given state; returns
+    # a (tokens, indent, state) tuple where indent is the indentation
+    # width if the line starts a new logical line (None otherwise) and
+    # state is the state at the start of the next line
+    def scan_line(self, line, state, lineno):
+        if self.token_re is None:
+            import re
+            PythonTokenizer.token_re = re.compile(r"""
+                (?P<ws>[ \t\f]+) |
+                (?P<comment>\#.*) |
+                (?P<string>[uUbB]?[rR]?(?:'''|\"\"\"|'|\")) |
+                (?P<name>[A-Za-z_]\w*) |
+                (?P<number>(?:0[xX][\da-fA-F]+|\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)[lLjJ]?) |
+                (?P<cont>\\$) |
+                (?P<op>\*\*=?|//=?|>>=?|<<=?|<>|!=|[-+*/%&|^=<>]=?|[][(){}.,:;@`~]|.)
+                """, re.VERBOSE)
+            for quote in (u"'", u'"'):
+                PythonTokenizer.string_end_re[quote] = re.compile(r'(?:[^\\%s]|\\.)*(?:%s|\\$)' % (quote, quote))
+                PythonTokenizer.string_end_re[quote*3] = re.compile(r'(?:[^\\]|\\.)*?%s' % (quote*3))
+        quote, brackets, cont = state
+        tokens = []
+        pos = 0
+        if quote is None and not brackets and not cont:
+            indent = len(line) - len(line.lstrip())
+            indent = len(line[:indent].expandtabs(8))
+        else:
+            indent = None
+        if quote is not None:
+            # string started in one of the previous lines
+            pos, quote = self.scan_string(line, 0, quote)
+            tokens.append((0, 'string', line[:pos]))
+        brackets = list(brackets)
+        cont = False
+        token_re = self.token_re
+        while quote is None and pos < len(line):
+            m = token_re.match(line, pos)
+            kind = m.lastgroup
+            value = m.group()
+            if kind == 'string':
+                end, quote = self.scan_string(line, m.end(), value.lstrip(u'uUbBrR'))
+                tokens.append((pos, kind, line[pos:end]))
+                pos = end
+                continue
+            elif kind == 'cont':
+                cont = True
+            elif kind in ('name', 'number', 'op'):
+                tokens.append((pos, kind, value))
+                if value in (u'(', u'[', u'{'):
+                    brackets.append((value, lineno, pos))
+                elif value in (u')', u']', u'}'):
+                    if brackets and brackets[-1][0] == self.brackets[value]:
+                        brackets.pop()
+            pos = m.end()
+        if indent is not None and not tokens:
+            # blank or comment line
+            indent = None
+        return tokens, indent, (quote, tuple(brackets), cont)
+
+    # scans the string starting at pos (after the opening quote); returns
+    # a (pos, quote) tuple where pos is the end of the string (or line)
+    # and quote is None if the string was terminated
+    def scan_string(self, line, pos, quote):
+        m = self.string_end_re[quote].match(line, pos)
+        if m is None:
+            if len(quote) == 1:
+                # unterminated string
+                return len(line), None
+            return len(line), quote
+        if len(quote) == 1 and m.group().endswith(u'\\') and m.end() == len(line):
+            # continued with a backslash
+            return len(line), quote
+        return m.end(), None
+
+    # returns the outline of the code as a list of (indent, kind, name,
+    # pos) tuples where kind is 'class', 'def', '=' (assignment to name)
+    # or None (other statements); a class or function contains the
+    # following items with greater indentation
+    def get_outline(self):
+        self.update()
+        revision = None
+        if self.window is not None:
+            revision = self.window.get_revision()
+        if revision is None or self.outline_revision != revision:
+            outline = []
+            for i in xrange(len(self.tokens)):
+                indent = self.indents[i]
+                if indent is None:
+                    continue
+                tokens = self.tokens[i]
+                kind = tokens[0][2]
+                if kind in (u'def', u'class') and len(tokens) > 1 and tokens[1][1] == 'name':
+                    outline.append((indent, kind, tokens[1][2], self.offsets[i] + tokens[0][0]))
+                    continue
+                # assignments like "a = ..." or "a, b = ..."
+                names = []
+                j = 0
+                while j + 1 < len(tokens) and tokens[j][1] == 'name':
+                    names.append(tokens[j])
+                    if tokens[j+1][2] != u',':
+                        break
+                    j += 2
+                if names and j + 1 < len(tokens) and tokens[j+1][2] == u'=':
+                    for col, kind, name in names:
+                        outline.append((indent, u'=', name, self.offsets[i] + col))
+                else:
+                    # other statements close the blocks too
+                    outline.append((indent, None, None, None))
+            self.outline = outline
+            self.outline_revision = revision
+        return self.outline
+
+    # returns the symbols defined by the code as a list of (name, kind, pos)
+    # tuples; these are the classes and functions (kind 'class' or 'def')
+    # defined at the module level or in classes, with names qualified by
+    # the class names (like 'Class.method'), and the module level
+    # assignments (kind '=')
+    def get_symbols(self):
+        symbols = []
+        lev = [(-1, u'', u'class')] # indent, name prefix, kind
+        for indent, kind, name, pos in self.get_outline():
+            while indent <= lev[-1][0]:
+                lev.pop()
+            if kind == u'=':
+                if len(lev) == 1:
+                    symbols.append((name, kind, pos))
+            elif kind is not None:
+                name = lev[-1][1] + name
+                if lev[-1][2] == u'class':
+                    symbols.append((name, kind, pos))
+                lev.append((indent, name + u'.', kind))
+        return symbols
+
+    # returns the logical lines starting with one of given keywords
+    # as lists of (pos, kind, value) tuples
+    def get_statements(self, keywords):
+        self.update()
+        lines = []
+        for i in xrange(len(self.tokens)):
+            if self.indents[i] is None or self.tokens[i][0][2] not in keywords:
+                continue
+            lines.append(self.get_logical_line(i))
+        return lines
+
+    # returns the tokens of the logical line starting at line i as
+    # (pos, kind, value) tuples
+    def get_logical_line(self, i):
+        tokens = []
+        n = len(self.tokens)
+        while True:
+            offset = self.offsets[i]
+            tokens.extend([(offset + col, kind, value) for col, kind, value in self.tokens[i]])
+            i += 1
+            if i >= n or self.indents[i] is not None or not self.tokens[i]:
+                break
+        return tokens
+
+    # returns the names bound by the import statements as a list of
+    # (name, pos, module, attr) tuples; attr is the name imported from
+    # the module or None if the module itself is bound to the name
+    def get_imports(self):
+        imports = []
+        for tokens in self.get_statements((u'import', u'from')):
+            values = [x[2] for x in tokens] + [None]
+            if values[0] == u'import':
+                i = 1
+                while i < len(tokens) and tokens[i][1] == 'name':
+                    pos = tokens[i][0]
+                    parts = [values[i]]
+                    i += 1
+                    while values[i] == u'.' and i + 1 < len(tokens):
+                        parts.append(values[i+1])
+                        i += 2
+                    if values[i] == u'as' and i + 1 < len(tokens):
+                        imports.append((values[i+1], tokens[i+1][0], u'.'.join(parts), None))
+                        i += 2
+                    else:
+                        imports.append((parts[0], pos, parts[0], None))
+                    if values[i] != u',':
+                        break
+                    i += 1
+            else:
+                i = 1
+                module = u''
+                while values[i] is not None and values[i] != u'import':
+                    module += values[i]
+                    i += 1
+                i += 1
+                if values[i] == u'(':
+                    i += 1
+                while i < len(tokens) and tokens[i][1] == 'name':
+                    if values[i+1] == u'as' and i + 2 < len(tokens):
+                        imports.append((values[i+2], tokens[i+2][0], module, values[i]))
+                        i += 3
+                    else:
+                        imports.append((values[i], tokens[i][0], module, values[i]))
+                        i += 1
+                    if values[i] != u',':
+                        break
+                    i += 1
+        return imports
+
+    # returns the names defined by the code as a dictionary mapping the
+    # names to lists of (pos, kind, module, attr) tuples; kind is 'class',
+    # 'def', '=' or 'import' (module and attr are set for imports only, see
+    # get_imports()); classes and functions nested in other classes and
+    # functions are also available under their qualified names (like
+    # 'Class.method')
+    def get_definitions(self):
+        self.update()
+        revision = None
+        if self.window is not None:
+            revision = self.window.get_revision()
+        if revision is None or self.definitions_revision != revision:
+            defs = {}
+            lev = [(-1, u'')] # indent, name prefix
+            for indent, kind, name, pos in self.get_outline():
+                while indent <= lev[-1][0]:
+                    lev.pop()
+                if kind is None:
+                    continue
+                defs.setdefault(name, []).append((pos, kind, None, None))
+                if kind != u'=':
+                    if len(lev) > 1:
+                        defs.setdefault(lev[-1][1] + name, []).append((pos, kind, None, None))
+                    lev.append((indent, lev[-1][1] + name + u'.'))
+            for name, pos, module, attr in self.get_imports():
+                defs.setdefault(name, []).append((pos, u'import', module, attr))
+            self.definitions = defs
+            self.definitions_revision = revision
+        return self.definitions
+
+    # returns a dict mapping every name used in the code to a sorted list
+    # of absolute positions of its occurrences; names in strings and
+    # comments are not included; the dict is cached until the text changes
+    def get_names(self):
+        self.update()
+        revision = None
+        if self.window is not None:
+            revision = self.window.get_revision()
+        if revision is None or self.names_revision != revision:
+            names = {}
+            offsets = self.offsets
+            tokens = self.tokens
+            for i in xrange(len(tokens)):
+                offset = offsets[i]
+                for col, kind, value in tokens[i]:
+                    if kind == 'name':
+                        names.setdefault(value, []).append(offset + col)
+            self.names = names
+            self.names_revision = revision
+        return self.names
+
+    # returns the scopes of the code as a list of [kind, name, indent,
+    # start, end, names, attrs] lists; the first one is the module scope
+    # (kind None), the others are the classes and functions (kind 'class'
+    # or 'def') in the order of their start positions; end is None for
+    # scopes open till the end of the code; names is a dict of the names
+    # bound in the scope (by assignments, imports, loops, arguments and
+    # definitions), attrs is a dict of the attributes assigned to self in
+    # the methods of a class; the scopes are cached until the text changes
+    def get_scopes(self):
+        self.update()
+        revision = None
+        if self.window is not None:
+            revision = self.window.get_revision()
+        if revision is None or self.scopes_revision != revision:
+            scopes = [[None, None, -1, 0, None, {}, {}]]
+            stack = scopes[:]
+            for i in xrange(len(self.tokens)):
+                indent = self.indents[i]
+                if indent is None:
+                    continue
+                tokens = self.get_logical_line(i)
+                pos = tokens[0][0]
+                while indent <= stack[-1][2]:
+                    stack.pop()[4] = pos
+                scope = stack[-1]
+                kind = tokens[0][2]
+                if kind in (u'def', u'class') and len(tokens) > 1 and tokens[1][1] == 'name':
+                    name = tokens[1][2]
+                    scope[5][name] = kind
+                    scope = [kind, name, indent, pos, None, {}, {}]
+                    if kind == u'def':
+                        self.scan_arguments(tokens, scope[5])
+                    scopes.append(scope)
+                    stack.append(scope)
+                    continue
+                attrs = None
+                if scope[0] == u'def' and len(stack) > 2 and stack[-2][0] == u'class':
+                    attrs = stack[-2][6]
+                self.scan_bindings(tokens, scope[5], attrs)
+            for name, pos, module, attr in self.get_imports():
+                for scope in scopes:
+                    if scope[3] <= pos and (scope[4] is None or pos < scope[4]):
+                        names = scope[5]
+                names[name] = u'import'
+            self.scopes = scopes
+            self.scopes_revision = revision
+        return self.scopes
+
+    # returns the scopes (see get_scopes()) containing pos, the innermost
+    # one first
+    def get_scope_chain(self, pos):
+        chain = []
+        for scope in self.get_scopes():
+            if scope[3] <= pos and (scope[4] is None or pos < scope[4]):
+                chain.insert(0, scope)
+        return chain
+
+    # returns the names visible at pos: the names of the scopes containing
+    # pos, except the classes other than the innermost scope
+    def get_visible_names(self, pos):
+        names = {}
+        chain = self.get_scope_chain(pos)
+        for i in xrange(len(chain)):
+            if i == 0 or chain[i][0] != u'class':
+                names.update(chain[i][5])
+        return names.keys()
+
+    # adds the arguments of a function definition (tokens of the def
+    # statement) to names
+    def scan_arguments(self, tokens, names):
+        depth = 0
+        prev = None
+        for pos, kind, value in tokens[2:]:
+            if value in (u'(', u'[', u'{'):
+                depth += 1
+            elif value in (u')', u']', u'}'):
+                depth -= 1
+                if depth <= 0:
+                    break
+            elif depth == 1 and kind == 'name' and prev in (u'(', u',', u'*', u'**'):
+                names[value] = u'arg'
+            prev = value
+
+    # adds the names bound by a statement (tokens of a logical line) by
+    # an assignment, a for loop or an "as" clause to names; the attributes
+    # assigned to self are added to attrs (if not None)
+    def scan_bindings(self, tokens, names, attrs):
+        values = [x[2] for x in tokens]
+        if values[0] == u'for':
+            try:
+                end = values.index(u'in')
+            except ValueError:
+                end = len(tokens)
+            self.scan_targets(tokens[1:end], names, attrs)
+        elif values[0] not in self.keywords:
+            # the targets are before the last "=" outside brackets
+            depth = 0
+            last = None
+            for k in xrange(len(tokens)):
+                value = values[k]
+                if value in (u'(', u'[', u'{'):
+                    depth += 1
+                elif value in (u')', u']', u'}'):
+                    depth -= 1
+                elif depth == 0:
+                    if value == u'=':
+                        last = k
+                    elif value == u'lambda':
+                        break
+            if last is not None:
+                self.scan_targets(tokens[:last], names, attrs)
+        for k in xrange(len(tokens) - 1):
+            if values[k] == u'as' and tokens[k+1][1] == 'name':
+                names[values[k+1]] = u'='
+
+    # adds the names in the targets of an assignment (tokens) to names
+    # and the attributes of self to attrs (if not None); names used in
+    # subscripts and calls are skipped
+    def scan_targets(self, tokens, names, attrs):
+        keywords = self.keywords
+        values = [x[2] for x in tokens] + [None]
+        stack = []
+        skip = 0 # depth of subscripts and calls
+        for k in xrange(len(tokens)):
+            value = values[k]
+            if value in (u'(', u'[', u'{'):
+                sub = k > 0 and (values[k-1] in (u')', u']') or
+                    tokens[k-1][1] == 'name' and values[k-1] not in keywords)
+                stack.append(sub)
+                if sub:
+                    skip += 1
+            elif value in (u')', u']', u'}'):
+                if stack and stack.pop():
+                    skip -= 1
+            elif skip or tokens[k][1] != 'name' or value in keywords or \
+                    values[k+1] in (u'.', u'(', u'['):
+                continue
+            elif k > 0 and values[k-1] == u'.':
+                if attrs is not None and k > 1 and values[k-2] == u'self' and \
+                        (k < 3 or values[k-3] != u'.'):
+                    attrs[value] = u'='
+            else:
+                names[value] = u'='
+
+
+# dictionary-like cache keeping up to size most recently used items
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.items = {}
+        # keys, the least recently used first
+        self.order = []
+
+    def get(self, key, default=None):
+        try:
+            value = self.items[key]
+        except KeyError:
+            return default
+        if self.order[-1] != key:
+            self.order.remove(key)
+            self.order.append(key)
+        return value
+
+    def set(self, key, value):
+        if self.items.has_key(key):
+            self.order.remove(key)
+        elif len(self.order) >= self.size:
+            del self.items[self.order.pop(0)]
+        self.items[key] = value
+        self.order.append(key)
+
+    def clear(self):
+        self.items.clear()
+        self.order = []
+
+
 class PythonModifier(object):
     py_namespace = {}
+    # number of lines above the caret searched for the current expression
+    py_context_lines = 20
+    # attribute kinds of recently completed objects, see py_get_attrs()
+    py_attrs_cache = LRUCache(16)
+    # signatures of the objects shown by Call Tip, see py_get_signature();
+    # objects which can't be weakly referenced go to the LRU cache
+    if WeakKeyDictionary is not None:
+        py_signatures = WeakKeyDictionary()
+    else:
+        py_signatures = None
+    py_signatures_cache = LRUCache(32)
 
     def __init__(self):
+        self.py_tokenizer = PythonTokenizer(self)
         edit_menu = self.menu.find(title=_('Edit'))[0].submenu
         edit_menu.append(ui.MenuItem(_('Call Tip'), target=self.py_calltip))
+        edit_menu.append(ui.MenuItem(_('Go to Definition'), target=self.py_goto_definition))
+        edit_menu.append(ui.MenuItem(_('Find References...'), target=self.py_find_references))
+        edit_menu.append(ui.MenuItem(_('Rename Symbol...'), target=self.py_rename_symbol))
 
     def py_reset_namespace(cls):
         import __main__
@@ -870,43 +2590,273 @@ class PythonModifier(object):
         cls.py_namespace.update(__main__.__dict__)
         cls.py_namespace.update(__main__.__builtins__.__dict__)
         cls.py_namespace['__name__'] = '__main__'
+        cls.py_attrs_cache.clear()
+        cls.py_signatures_cache.clear()
     py_reset_namespace = classmethod(py_reset_namespace)
 
-    def _get_text(self):
-        return self.body.get(), self.body.get_pos()
-
-    def _get_objects(self, exp):
-        i = exp.rfind('.')
-        if i > 0:
-            exp, limit = exp[:i], exp[i+1:]
-        elif i == 0: # expression cannot start with a dot
-            return {}
+    # returns a dict mapping the attribute names of an object to their
+    # kinds (see py_get_attr_kind()), name is the expression the object
+    # was found with; the dicts are cached by the identity of the object
+    # and the file and modification time of its module until the namespace
+    # is reset or a script is run
+    def py_get_attrs(cls, obj, name=None):
+        import types
+        if isinstance(obj, types.ModuleType):
+            module = obj
         else:
-            exp, limit = '', exp
-        limit = limit.strip()
-        if exp:
-            # expression
-            namespace = sys.modules.copy()
-            namespace.update(self.py_namespace)
+            if isinstance(obj, (types.ClassType, type)):
+                klass = obj
+            else:
+                klass = getattr(obj, '__class__', type(obj))
+            module = sys.modules.get(getattr(klass, '__module__', None))
+        filename = getattr(module, '__file__', None)
+        mtime = None
+        if filename:
             try:
-                d = [x for x in eval('dir(%s)' % exp, namespace) if x.startswith(limit)]
-                return dict([(x, eval('%s.%s' % (exp, x), namespace)) for x in d])
-            except:
+                mtime = os.stat(filename).st_mtime
+            except OSError:
                 pass
+        # the entries keep weak references to the objects, so an id reused
+        # by another object is detected; the objects which can't be weakly
+        # referenced (modules, instances of builtin types) are keyed by
+        # the expression and their type instead
+        try:
+            ref = weakref(obj)
+            key = (id(obj), filename, mtime)
+        except TypeError:
+            ref = None
+            key = (name, type(obj), filename, mtime)
+        entry = cls.py_attrs_cache.get(key)
+        if entry is not None and (entry[0] is None or entry[0]() is obj):
+            return entry[1]
+        attrs = {}
+        for x in dir(obj):
+            attrs[x] = cls.py_get_attr_kind(obj, x)
+        if ref is not None or name is not None:
+            cls.py_attrs_cache.set(key, (ref, attrs))
+        return attrs
+    py_get_attrs = classmethod(py_get_attrs)
+
+    # returns the kind of an attribute of an object: 'module', 'class',
+    # 'def' (callables) or '=' (other values); the attribute is looked up
+    # in the dicts of the object and its classes, so no properties or
+    # __getattr__() methods are run
+    def py_get_attr_kind(obj, name):
+        import types
+        if isinstance(obj, (types.ClassType, type)):
+            classes = [obj]
         else:
-            # globals
+            classes = [obj, getattr(obj, '__class__', type(obj))]
+        i = 0
+        while i < len(classes):
             try:
-                d = [x for x in eval('dir()', self.py_namespace) if x.startswith(limit)]
-                return dict([(x, eval(x, self.py_namespace)) for x in d])
+                value = classes[i].__dict__[name]
+            except (AttributeError, KeyError, TypeError):
+                classes.extend(list(getattr(classes[i], '__bases__', ())))
+                i += 1
+                continue
+            if isinstance(value, types.ModuleType):
+                return u'module'
+            if isinstance(value, (types.ClassType, type)):
+                return u'class'
+            if callable(value) or isinstance(value, (staticmethod, classmethod)):
+                return u'def'
+            break
+        return u'='
+    py_get_attr_kind = staticmethod(py_get_attr_kind)
+
+    # returns an (args, doc) tuple for a callable object where args is
+    # the list of the arguments (None if unknown) and doc is the stripped
+    # docstring; the tuples are cached by the objects
+    def py_get_signature(cls, obj):
+        import types
+        if type(obj) == types.MethodType:
+            # bound methods are created on every access, use the function
+            args, doc = cls.py_get_signature(obj.im_func)
+            if args:
+                args = args[1:]
+            return args, doc
+        if cls.py_signatures is not None:
+            try:
+                return cls.py_signatures[obj]
+            except (KeyError, TypeError):
+                pass
+        entry = cls.py_signatures_cache.get(id(obj))
+        if entry is not None and entry[0] is obj:
+            return entry[1]
+        signature = cls.py_make_signature(obj)
+        try:
+            cls.py_signatures[obj] = signature
+        except TypeError:
+            # also when py_signatures is None; the object is kept in
+            # the entry, so its id can't be reused
+            cls.py_signatures_cache.set(id(obj), (obj, signature))
+        return signature
+    py_get_signature = classmethod(py_get_signature)
+
+    # creates the (args, doc) tuple for py_get_signature()
+    def py_make_signature(obj):
+        import types
+        argoffset = 0
+        if type(obj) in (types.ClassType, types.TypeType):
+            def find_init(obj):
+                try:
+                    return obj.__init__.im_func
+                except AttributeError:
+                    for base in obj.__bases__:
+                        fob = find_init(base)
+                        if fob is not None:
+                            return fob
+            fob = find_init(obj)
+            if fob is None:
+                fob = lambda: None
+            else:
+                argoffset = 1
+        else:
+            fob = obj
+        args = None
+        if type(fob) in (types.FunctionType, types.LambdaType):
+            try:
+                real_args = fob.func_code.co_varnames[argoffset:fob.func_code.co_argcount]
+                defaults = fob.func_defaults or []
+                defaults = list(['=%s' % repr(x) for x in defaults])
+                defaults = [''] * (len(real_args) - len(defaults)) + defaults
+                args = map(lambda arg, dflt: arg+dflt, real_args, defaults)
+                if fob.func_code.co_flags & 0x4:
+                    args.append('...')
+                if fob.func_code.co_flags & 0x8:
+                    args.append('***')
             except:
                 pass
-        return {}
+        doc = getattr(obj, '__doc__', '')
+        if doc:
+            while doc[:1] in ' \t\n':
+                doc = doc[1:]
+        return args, doc
+    py_make_signature = staticmethod(py_make_signature)
+
+    # returns the text around the caret and the caret position in it,
+    # see TextWindow.get_text_window()
+    def _get_text(self, lines=None):
+        if lines is None:
+            lines = self.py_context_lines
+        return self.get_text_window(before=lines)
+
+    # returns the value of an expression in the namespace of the shell;
+    # dotted names are resolved by looking up the attributes, only other
+    # expressions are evaluated
+    def _eval(self, exp):
+        parts = [x.strip() for x in exp.split('.')]
+        for part in parts:
+            if not part or part[0].isdigit() or not part.replace('_', 'a').isalnum():
+                namespace = sys.modules.copy()
+                namespace.update(self.py_namespace)
+                return eval(exp, namespace)
+        try:
+            obj = self.py_namespace[parts[0]]
+        except KeyError:
+            obj = sys.modules[parts[0]]
+        for part in parts[1:]:
+            obj = getattr(obj, part)
+        return obj
+
+    # returns the names from the namespace of the shell for the completion
+    # of an expression: the attributes of the object the part before the
+    # last dot refers to (or the globals) starting with the part after the
+    # last dot; the values of the attributes are not read
+    def _get_names(self, exp):
+        i = exp.rfind('.')
+        if i == 0: # expression cannot start with a dot
+            return []
+        try:
+            if i > 0:
+                obj = self._eval(exp[:i])
+                names = self.py_get_attrs(obj, exp[:i].strip()).keys()
+            else:
+                names = self.py_namespace.keys()
+        except:
+            return []
+        limit = exp[i+1:].strip()
+        return [x for x in names if x.startswith(limit)]
+
+    # returns the names for the completion of an expression found in the
+    # code itself (see PythonTokenizer.get_scopes()); nothing is executed
+    def _get_static_names(self, exp):
+        i = exp.rfind('.')
+        if i == 0:
+            return []
+        pos = self.body.get_pos()
+        if i < 0:
+            names = self.py_tokenizer.get_visible_names(pos)
+        else:
+            try:
+                parts = exp[:i].decode('latin1').split(u'.')
+            except UnicodeError:
+                return []
+            names = self._get_static_attrs([x.strip() for x in parts], pos)
+        limit = exp[i+1:].strip()
+        return [x for x in names if x.startswith(limit)]
+
+    # returns the names for the completion in an import statement (the
+    # names of the modules from the module index and after "from module
+    # import" also the names defined in the module) or None if the caret
+    # is not in an import statement
+    def _get_import_names(self):
+        import re
+        text, pos = self._get_text(0)
+        line = text[:pos]
+        path = getattr(self, 'path', None)
+        if path:
+            path = os.path.split(path)[0]
+        m = re.match(r'\s*(?:import\s+(?:[\w.]+(?:\s+as\s+\w+)?\s*,\s*)*|from\s+)([\w.]*)$', line)
+        if m:
+            parts = m.group(1).split(u'.')
+            package = u'.'.join(parts[:-1])
+            limit = parts[-1]
+            if package.startswith(u'.'):
+                return []
+            names = app.module_index.get_modules(package, path)
+        else:
+            m = re.match(r'\s*from\s+([\w.]+)\s+import\s+(?:\(\s*)?(?:\w+(?:\s+as\s+\w+)?\s*,\s*)*(\w*)$', line)
+            if not m:
+                return None
+            module, limit = m.groups()
+            names = []
+            if not module.startswith(u'.'):
+                names = app.module_index.get_modules(module, path)
+            filename = self.py_find_module(module, path)
+            if filename is not None:
+                names = names + app.symbol_index.get_file_scopes(filename)[0][5].keys()
+        return [x for x in names if x.startswith(limit)]
+
+    # returns the attribute names of the object the dotted name (list of
+    # names) refers to; the name is looked up like in py_goto_definition()
+    def _get_static_attrs(self, parts, pos):
+        tokenizer = self.py_tokenizer
+        if parts == [u'self']:
+            for scope in tokenizer.get_scope_chain(pos):
+                if scope[0] == u'class':
+                    return scope[5].keys() + scope[6].keys()
+            return []
+        found = self.py_find_definition(parts, tokenizer.get_definitions())
+        if found is None:
+            return []
+        path, pos = found
+        if path is None:
+            scopes = tokenizer.get_scopes()
+        else:
+            scopes = app.symbol_index.get_file_scopes(path)
+            if not pos:
+                # module
+                return scopes[0][5].keys()
+        for scope in scopes:
+            if scope[3] == pos and scope[0] == u'class':
+                return scope[5].keys() + scope[6].keys()
+        return []
 
     def _get_object(self, exp):
-        d = self._get_objects(exp)
         try:
-            # if rfind() returns -1 then we will get whole <exp>
-            return d[exp[exp.rfind('.')+1:]]
+            return self._eval(exp)
         except:
             pass
 
@@ -971,42 +2921,16 @@ class PythonModifier(object):
         return title.strip().decode('latin1')
 
     def py_insert_indent(self):
-        text, pos = self._get_text()
-        pos -= 1
-        i = pos-1
-
-        # walk back to the start of line
-        while i >= 0:
-            if text[i] in (u'\u2028', u'\u2029'):
-                break
-            i -= 1
-        i += 1
-        strt = i
+        self.add_text(u' ' * self.py_get_indent())
 
-        # walk forward to the start of text
-        while i < pos and text[i].isspace():
-            i += 1
-
-        # calculate indent of the previous line
-        ind = i-strt
-        if pos > 0:
-            if text[pos-1] == u':':
-                # add more indent if line ends with a colon
-                ind += app.settings.python.indentsize
-            else:
-                # add more indent if line has unmatched brackets
-                level = 0
-                # i is already set here
-                #i = strt+ind
-                while i < pos:
-                    if text[i] in u'([{':
-                        level += 1
-                    elif text[i] in u')]}':
-                        level -= 1
-                    i += 1
-                if level > 0:
-                    ind += app.settings.python.indentsize
-        self.body.add(u' '*ind)
+    # returns the indentation for the line with the caret computed from
+    # the state of the tokenizer at its start (see PythonTokenizer.get_indent())
+    def py_get_indent(self):
+        i = self.get_line_table().index(self.body.get_pos())
+        if i == 0:
+            return 0
+        return self.py_tokenizer.get_indent(i, app.settings.python.indentsize,
+            self.get_line(i)[2])
 
     def py_autocomplete(self):
         # parse back to get the expression
@@ -1015,11 +2939,26 @@ class PythonModifier(object):
         # build the menu
         
         menu = ui.Menu('%s*' % self._expression_to_title(exp))
-        menu.extend([ui.MenuItem(title) for title in self._get_objects(exp).keys()])
-        menu.extend([ui.MenuItem(title, offset=off) for title, off in statements \
-            if title.startswith(exp)])
-        menu.sort()
-        symbitems = [ui.MenuItem(title, offset=off) for title, off in symbols]
+        store = app.completion_store
+        names = {}
+        imports = self._get_import_names()
+        if imports is not None:
+            # only modules and their contents in import statements
+            for name in imports:
+                names[name] = True
+        else:
+            for name in self._get_names(exp) + self._get_static_names(exp):
+                names[unicode(name)] = True
+        candidates = [(x.lower(), x, None) for x in names.keys()]
+        candidates.sort()
+        prefix = exp.decode('latin1')
+        if imports is None and u'.' not in prefix:
+            # keywords, statements and module names, already sorted
+            candidates = merge_sorted(candidates, [(x.lower(), x, off) \
+                for x, off in store.find(prefix) if not names.has_key(x)])
+        menu.extend([ui.MenuItem(title, offset=off) \
+            for title, off in store.rank([x[1:] for x in candidates])])
+        symbitems = [ui.MenuItem(title, offset=off, symbol=True) for title, off in symbols]
         if exp:
             menu.extend(symbitems)
         else:
@@ -1033,7 +2972,9 @@ class PythonModifier(object):
             n = exp.split(u'.')[-1]
             if s.startswith(n):
                 s = s[len(n):]
-            self.body.add(s)
+            self.add_text(s)
+            if not getattr(item, 'symbol', False):
+                store.add_use(ws)
             if hasattr(item, 'offset'): # statement, symbol
                 if item.offset is not None:
                     self.body.set_pos(self.body.get_pos() - len(ws) + item.offset)
@@ -1081,56 +3022,30 @@ class PythonModifier(object):
                 win.menu = menu
             # try to get the object
             obj = self._get_object(exp)
+            entry = None
+            arg_text = ''
             if obj is not None:
-                # check the type of the object and try to obtain the function object
-                import types
-                argoffset = 0
-                arg_text = ''
-                if type(obj) in (types.ClassType, types.TypeType):
-                    def find_init(obj):
-                        try:
-                            return obj.__init__.im_func
-                        except AttributeError:
-                            for base in obj.__bases__:
-                                fob = find_init(base)
-                                if fob is not None:
-                                    return None
-                    fob = find_init(obj)
-                    if fob is None:
-                        fob = lambda: None
-                    else:
-                        argoffset = 1
-                elif type(obj) == types.MethodType:
-                    fob = obj.im_func
-                    argoffset = 1
-                else:
-                    fob = obj
-                if type(fob) in (types.FunctionType, types.LambdaType):
-                    try:
-                        real_args = fob.func_code.co_varnames[argoffset:fob.func_code.co_argcount]
-                        defaults = fob.func_defaults or []
-                        defaults = list(['=%s' % repr(x) for x in defaults])
-                        defaults = [''] * (len(real_args) - len(defaults)) + defaults
-                        items = map(lambda arg, dflt: arg+dflt, real_args, defaults)
-                        if fob.func_code.co_flags & 0x4:
-                            items.append('...')
-                        if fob.func_code.co_flags & 0x8:
-                            items.append('***')
-                        arg_text = '%s(%s)' % (title, ', '.join(items))
-                    except:
-                        pass
-                doc = getattr(obj, '__doc__', '')
+                args, doc = self.py_get_signature(obj)
+                if args is not None:
+                    arg_text = '%s(%s)' % (title, ', '.join(args))
                 if doc:
-                    while doc[:1] in ' \t\n':
-                        doc = doc[1:]
                     if not arg_text:
                         arg_text = title
                     arg_text += '\n\n' + doc
+            else:
+                # not in the namespace, try the calltips database
+                entry = app.calltips.find(self._get_calltip_names(exp))
+                if entry is not None:
+                    args, doc = entry
+                    arg_text = u'%s(%s)' % (title, args)
+                    if doc:
+                        arg_text += u'\n\n' + doc
+            if obj is not None or entry is not None:
                 if arg_text:
                     text = unicode(arg_text)
                     # display the call-tip
                     if win:
-                        win.body.add(text + u'\n')
+                        win.add_text(text + u'\n')
                     else:
                         # we use a timer to let the screen refresh if we were called
                         # from a shortcut; if we won't do it, the Text control text
@@ -1153,13 +3068,411 @@ class PythonModifier(object):
         else:
             ui.note(stdhelp)
             
+    # returns the names under which the expression may be found in the
+    # calltips database (see CalltipDatabase); names bound by the imports
+    # in the code are replaced by the names of the imported modules
+    def _get_calltip_names(self, exp):
+        parts = [x.strip() for x in exp.split('.')]
+        names = ['.'.join(parts)]
+        try:
+            entries = self.py_tokenizer.get_definitions().get(parts[0].decode('latin1'), [])
+        except UnicodeError:
+            entries = []
+        for pos, kind, module, attr in entries:
+            if kind == u'import':
+                full = [module]
+                if attr is not None:
+                    full.append(attr)
+                try:
+                    names.insert(0, '.'.join([x.encode('latin1') for x in full] + parts[1:]))
+                except UnicodeError:
+                    pass
+        return names
+
     def py_calltip_scheduled(self):
         ui.schedule(self.py_calltip)
 
+    # returns the dotted name under the caret as a list of names, the part
+    # right to the caret ends at the first dot
+    def py_get_dotted_name(self):
+        text, pos = self._get_text(0)
+        chars = u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_'
+        end = pos
+        while end < len(text) and text[end] in chars:
+            end += 1
+        beg = pos
+        while beg > 0 and (text[beg-1] in chars or text[beg-1] == u'.'):
+            beg -= 1
+        return [x for x in text[beg:end].split(u'.') if x]
+
+    # returns the path of the file of a module found in sys.path (and in
+    # path for implicit relative imports) or None; relative module names
+    # (starting with dots) are looked up in path only
+    def py_find_module(self, module, path=None):
+        if module.startswith(u'.'):
+            # relative import, path is the folder of the importing module
+            if path is None:
+                return None
+            name = module.lstrip(u'.')
+            for i in xrange(len(module) - len(name) - 1):
+                path = os.path.split(path)[0]
+            if not name:
+                # the package itself
+                path = os.path.join(path, '__init__.py')
+                if os.path.isfile(path):
+                    return path
+                return None
+            paths = [path]
+            module = name
+        else:
+            paths = list(sys.path)
+            if path is not None:
+                paths.insert(0, path)
+        if not module:
+            return None
+        parts = module.encode('utf8').split('.')
+        for path in paths:
+            if not os.path.isdir(path):
+                continue
+            path = os.path.join(path, *parts)
+            if os.path.isfile(path + '.py'):
+                return path + '.py'
+            path = os.path.join(path, '__init__.py')
+            if os.path.isfile(path):
+                return path
+        return None
+
+    # looks for the definition of the dotted name (list of names) in the
+    # definitions (see PythonTokenizer.get_definitions()) of the code from
+    # a file at path (None for the text of this window); follows the
+    # imports; returns a (path, pos) tuple or None
+    def py_find_definition(self, parts, defs, path=None, depth=0):
+        if depth > 8 or not parts:
+            return None
+        if parts[0] == u'self' and len(parts) > 1:
+            return self.py_find_member(parts[1], defs, path)
+        # qualified names of nested classes and functions
+        for i in xrange(len(parts), 1, -1):
+            entries = defs.get(u'.'.join(parts[:i]))
+            if entries:
+                return path, entries[0][0]
+        entries = defs.get(parts[0])
+        if not entries:
+            return None
+        # prefer classes and functions to imports and assignments
+        order = {u'class': 0, u'def': 0, u'import': 1, u'=': 2}
+        lst = [(order[x[1]], i, x) for i, x in zip(xrange(len(entries)), entries)]
+        lst.sort()
+        pos, kind, module, attr = lst[0][-1]
+        if kind != u'import':
+            return path, pos
+        rest = parts[1:]
+        if attr is not None:
+            rest.insert(0, attr)
+        mpath = None
+        if path is not None:
+            mpath = os.path.split(path)[0]
+        elif getattr(self, 'path', None):
+            mpath = os.path.split(self.path)[0]
+        # the longest module name which can be found
+        for i in xrange(len(rest), -1, -1):
+            if module.endswith(u'.'):
+                # relative import of a package, like 'from . import x'
+                name = module + u'.'.join(rest[:i])
+            else:
+                name = u'.'.join([module] + rest[:i])
+            filename = self.py_find_module(name, mpath)
+            if filename is not None:
+                break
+        else:
+            return path, pos
+        if i == len(rest):
+            return filename, 0
+        found = self.py_find_definition(rest[i:],
+            app.symbol_index.get_file_definitions(filename), filename, depth + 1)
+        if found is None:
+            return filename, 0
+        return found
+
+    # looks for the definition of an attribute of self: a member of the
+    # class enclosing the caret (a method or an attribute assigned to self
+    # in its methods) or, if there is none, a method of any other class;
+    # returns a (path, pos) tuple or None
+    def py_find_member(self, name, defs, path=None):
+        if path is None:
+            tokenizer = self.py_tokenizer
+            chain = tokenizer.get_scope_chain(self.body.get_pos())
+            for i in xrange(len(chain)):
+                scope = chain[i]
+                if scope[0] != u'class':
+                    continue
+                # qualified name of the class
+                names = [x[1] for x in chain[i:-1]]
+                names.reverse()
+                entries = defs.get(u'.'.join(names + [name]))
+                if entries:
+                    return path, entries[0][0]
+                if scope[6].has_key(name):
+                    # prefer the assignments to the other uses
+                    found = None
+                    for pos in tokenizer.get_names().get(name, []):
+                        if pos < scope[3] or (scope[4] is not None and pos >= scope[4]):
+                            continue
+                        if self.body.get(pos - 5, 5) != u'self.':
+                            continue
+                        after = self.body.get(pos + len(name), 3).lstrip()
+                        if after[:1] == u'=' and after[:2] != u'==':
+                            return path, pos
+                        if found is None:
+                            found = pos
+                    if found is not None:
+                        return path, found
+                break
+        found = None
+        for key, entries in defs.items():
+            if key.endswith(u'.' + name):
+                pos = entries[0][0]
+                if found is None or pos < found:
+                    found = pos
+        if found is None:
+            return None
+        return path, found
+
+    def py_goto_definition(self):
+        parts = self.py_get_dotted_name()
+        if not parts:
+            ui.note(_('No name at the cursor'))
+            self.reset_control_key()
+            return
+        found = self.py_find_definition(parts, self.py_tokenizer.get_definitions())
+        if found is None:
+            ui.note(_('Definition of "%s" not found') % u'.'.join(parts))
+        else:
+            path, pos = found
+            if path is None:
+                self.body.set_pos(pos)
+            else:
+                win = app.load_file(path)
+                if win:
+                    win.body.set_pos(pos)
+        self.reset_control_key()
+
+    # returns the name under the caret or None
+    def py_get_name(self):
+        parts = self.py_get_dotted_name()
+        if not parts:
+            return None
+        return parts[-1]
+
+    # lists the occurrences of the name under the caret in the opened
+    # Python files and optionally in the Python files of a folder
+    def py_find_references(self):
+        self.reset_control_key()
+        name = self.py_get_name()
+        if name is None:
+            ui.note(_('No name at the cursor'))
+            return
+        menu = ui.Menu(_('Find References'))
+        menu.append(ui.MenuItem(_('Opened files'), folder=False))
+        menu.append(ui.MenuItem(_('Opened files and folder...'), folder=True))
+        item = menu.popup()
+        if item is None:
+            return
+        path = None
+        if item.folder:
+            path = getattr(self, 'path', None)
+            if path:
+                path = os.path.split(path)[0]
+            path = app.ask_folder(_('Find References'), path)
+            if path is None:
+                return
+        win = FindInFilesWindow(title=_('References: %s') % name,
+            results=app.iter_references(name, path))
+        win.open()
+
+    # returns the scope (see PythonTokenizer.get_scopes()) binding the name
+    # at pos in the text of the tokenizer: the innermost scope containing
+    # pos which binds it, skipping the classes other than the innermost
+    # scope; the module scope for the global and builtin names
+    def py_get_binding_scope(self, tokenizer, text, pos, name):
+        chain = tokenizer.get_scope_chain(pos)
+        if chain[0][0] is not None and \
+                text[chain[0][3]:pos].split() == [chain[0][0]]:
+            # name of a class or function in its own definition
+            del chain[0]
+        for i in xrange(len(chain)):
+            scope = chain[i]
+            if i > 0 and scope[0] == u'class':
+                continue
+            if scope[5].has_key(name):
+                return scope
+        return chain[-1]
+
+    # returns the name before the dot if the name at pos in text is an
+    # attribute (u'' if it isn't a simple name), None otherwise
+    def py_get_owner(self, text, pos):
+        i = pos - 1
+        while i >= 0 and text[i] in u' \t':
+            i -= 1
+        if i < 0 or text[i] != u'.':
+            return None
+        i -= 1
+        while i >= 0 and text[i] in u' \t':
+            i -= 1
+        end = i + 1
+        while i >= 0 and (text[i].isalnum() or text[i] == u'_'):
+            i -= 1
+        return text[i+1:end]
+
+    # returns the innermost class scope containing pos or None
+    def py_get_class_scope(self, tokenizer, pos):
+        for scope in tokenizer.get_scope_chain(pos):
+            if scope[0] == u'class':
+                return scope
+        return None
+
+    # returns a list of (window, positions) tuples with the occurrences of
+    # the symbol at pos of this window in the opened Python files: the uses
+    # of a local name bound in the same scope, the members of the same
+    # class (used directly in the class, through self or the class name),
+    # the global names (also imported by other files or used through the
+    # module name) or, for other attributes, the attributes of this name
+    # and the members of all classes
+    def py_get_symbol_positions(self, name, pos):
+        text = self.body.get()
+        tokenizer = self.py_tokenizer
+        owner = self.py_get_owner(text, pos)
+        scope = None
+        if owner is None:
+            scope = self.py_get_binding_scope(tokenizer, text, pos, name)
+        elif owner == u'self':
+            scope = self.py_get_class_scope(tokenizer, pos)
+        else:
+            for x in tokenizer.get_scopes():
+                if x[0] == u'class' and x[1] == owner:
+                    scope = x
+                    break
+        result = []
+        if scope is not None and scope[0] is not None:
+            # local name or class member, only in this file
+            positions = []
+            for x in tokenizer.get_names().get(name, []):
+                owner = self.py_get_owner(text, x)
+                if owner is None:
+                    ok = self.py_get_binding_scope(tokenizer, text, x, name) is scope
+                elif scope[0] != u'class':
+                    ok = False
+                elif owner == u'self':
+                    ok = self.py_get_class_scope(tokenizer, x) is scope
+                else:
+                    ok = owner == scope[1]
+                if ok:
+                    positions.append(x)
+            return [(self, positions)]
+        module = None
+        if scope is not None and getattr(self, 'path', None):
+            module = os.path.splitext(os.path.split(self.path)[1])[0].decode('utf8')
+        for win in ui.screen.find_windows(PythonFileWindow):
+            if scope is not None and win is not self and module is None:
+                continue
+            wtext = win.body.get()
+            wtokenizer = win.py_tokenizer
+            imported = win is self
+            if not imported and scope is not None:
+                # global name of this file imported by the other one
+                for x in wtokenizer.get_imports():
+                    if x[0] == name and x[3] == name and \
+                            (x[2] == module or x[2].endswith(u'.' + module)):
+                        imported = True
+                        break
+            positions = []
+            for x in wtokenizer.get_names().get(name, []):
+                owner = self.py_get_owner(wtext, x)
+                binding = None
+                if owner is None:
+                    binding = self.py_get_binding_scope(wtokenizer, wtext, x, name)
+                if scope is None:
+                    # any attribute or class member
+                    ok = owner is not None or binding[0] == u'class'
+                elif owner is None:
+                    ok = imported and binding[0] is None
+                else:
+                    ok = win is not self and owner == module
+                if ok:
+                    positions.append(x)
+            if positions:
+                result.append((win, positions))
+        return result
+
+    # renames the symbol under the caret in all opened Python files, see
+    # py_get_symbol_positions(); every changed file is rewritten at once
+    def py_rename_symbol(self):
+        import re
+        self.reset_control_key()
+        name = self.py_get_name()
+        if name is None:
+            ui.note(_('No name at the cursor'))
+            return
+        # keywords and self are not symbols, every occurrence of them
+        # would be replaced
+        if PythonTokenizer.keywords.has_key(name) or name == u'self':
+            ui.note(_('Cannot rename "%s"') % name, 'error')
+            return
+        new_name = ui.query(_('Rename "%s" to:') % name, 'text', name)
+        if not new_name or new_name == name:
+            return
+        if not re.match(r'[A-Za-z_][A-Za-z0-9_]*$', new_name) or \
+                PythonTokenizer.keywords.has_key(new_name):
+            ui.note(_('Invalid name'), 'error')
+            return
+        # the occurrence under the caret
+        caret = self.body.get_pos()
+        pos = None
+        for x in self.py_tokenizer.get_names().get(name, []):
+            if x <= caret:
+                pos = x
+        if pos is None or pos + len(name) < caret:
+            ui.note(_('Not found'))
+            return
+        windows = []
+        count = 0
+        for win, positions in self.py_get_symbol_positions(name, pos):
+            if positions:
+                windows.append((win, positions))
+                count += len(positions)
+        if not windows:
+            ui.note(_('Not found'))
+            return
+        if not ui.query(_('Rename %d occurrences in %d files?') % (count, len(windows)), 'query'):
+            return
+        for win, positions in windows:
+            win.py_replace_names(positions, len(name), new_name)
+
+    # replaces the names of given length at positions (sorted) with
+    # new_name, the text is set only once
+    def py_replace_names(self, positions, length, new_name):
+        text = self.body.get()
+        pos = self.body.get_pos()
+        newpos = pos
+        pieces = []
+        last = 0
+        for start in positions:
+            pieces.append(text[last:start])
+            pieces.append(new_name)
+            last = start + length
+            if start < pos:
+                newpos += len(new_name) - length
+        pieces.append(text[last:])
+        self.set_text(u''.join(pieces))
+        self.body.set_pos(max(newpos, 0))
+
     def get_shortcuts(cls):
         menu = ui.Menu()
         menu.append(ui.MenuItem(_('Call Tip'), method=cls.py_calltip_scheduled))
         menu.append(ui.MenuItem(_('Autocomplete'), method=cls.py_autocomplete))
+        menu.append(ui.MenuItem(_('Go to Definition'), method=cls.py_goto_definition))
+        menu.append(ui.MenuItem(_('Find References...'), method=cls.py_find_references))
+        menu.append(ui.MenuItem(_('Rename Symbol...'), method=cls.py_rename_symbol))
         return menu
     get_shortcuts = classmethod(get_shortcuts)
 
@@ -1167,6 +3480,33 @@ class PythonModifier(object):
 PythonModifier.py_reset_namespace()
 
 
+# node of the tree returned by PythonFileWindow.parse_lines()
+class PythonCodeNode(object):
+    __slots__ = ('name', 'kind', 'pos', 'children')
+
+    def __init__(self, name=None, kind=None, pos=None):
+        self.name = name
+        self.kind = kind
+        self.pos = pos
+        # list of nodes sorted by name
+        self.children = []
+
+    def get_title(self):
+        if self.kind == u'def':
+            return u'%s()' % self.name
+        return self.name
+
+    # sorts the children of this node and all its descendants
+    def sort(self):
+        lst = []
+        for i in xrange(len(self.children)):
+            node = self.children[i]
+            node.sort()
+            lst.append((node.name.lower(), i, node))
+        lst.sort()
+        self.children = [x[-1] for x in lst]
+
+
 class PythonCodeBrowserWindow(Window, ui.FilteredListboxModifier):
     def __init__(self, **kwargs):
         self.tree = pop(kwargs, 'tree')
@@ -1181,22 +3521,19 @@ class PythonCodeBrowserWindow(Window, ui.FilteredListboxModifier):
         self.menu.append(self.filter_menu_item)
         self.menu.append(ui.MenuItem(_('Exit'), target=self.close))
         self.keys += (ui.EKeyLeftArrow, ui.EKeyRightArrow)
+        # (tree, index) tuples of the parent trees
         self.stack = []
         
     def make_display_list(self):
         lst = []
-        for name in self.make_list():
-            if self.tree[name][-1]:
+        for node in self.tree.children:
+            name = node.get_title()
+            if node.children:
                 name += ' ->'
             lst.append(name)
         if not lst:
             lst.append(_('(no data)'))
         return lst
-        
-    def make_list(self):
-        lst = self.tree.keys()
-        lst.sort(lambda a, b: -(a.lower() < b.lower()))
-        return lst
 
     def key_press(self, key):
         if key == ui.EKeyLeftArrow:
@@ -1207,69 +3544,51 @@ class PythonCodeBrowserWindow(Window, ui.FilteredListboxModifier):
             Window.key_press(self, key)
             ui.FilteredListboxModifier.key_press(self, key)
 
-    def current_name(self):
+    def current_node(self):
         i = self.current()
         if i < 0:
             return
-        lst = self.make_list()
         try:
-            return lst[i]
+            return self.tree.children[i]
         except IndexError:
             return
 
     def click(self):
-        name = self.current_name()
-        if name is None:
-            return
-        try:
-            newtree = self.tree[name][-1]
-        except KeyError:
+        node = self.current_node()
+        if node is None:
             return
         menu = ui.Menu()
         menu.append(self.menu[0]) # Select
-        if newtree:
+        if node.children:
             menu.append(self.menu[1]) # Browse
         item = menu.popup()
         if item is not None:
             item.target()
 
     def select_click(self):
-        name = self.current_name()
-        if name is None:
-            return
-        try:
-            self.modal_result = self.tree[name][0]
-        except KeyError:
+        node = self.current_node()
+        if node is None:
             return
+        self.modal_result = node.pos
         self.close()
         
     def back_click(self):
-        oldtree = self.tree
         try:
-            self.tree = self.stack.pop()
+            self.tree, pos = self.stack.pop()
         except IndexError:
             return
-        pos = [self.tree[name][-1] for name in self.make_list()].index(oldtree)
         self.set_filter(None)
         self.filter_title = self.filter_title[:self.title.rindex(u'.')]
         self.set_list(self.make_display_list(), pos)
         
     def browse_click(self):
-        name = self.current_name()
-        if name is None:
-            return
-        try:
-            newtree = self.tree[name][-1]
-        except KeyError:
+        node = self.current_node()
+        if node is None or not node.children:
             return
-        if not newtree:
-            return
-        self.stack.append(self.tree)
-        self.tree = newtree
-        if name.endswith('()'):
-            name = name[:-2]
+        self.stack.append((self.tree, self.current()))
+        self.tree = node
         self.set_filter(None)
-        self.filter_title += u'.%s' % name
+        self.filter_title += u'.%s' % node.name
         self.set_list(self.make_display_list(), 0)
 
 
@@ -1282,9 +3601,11 @@ class PythonFileWindow(TextFileWindow, PythonModifier):
         PythonModifier.__init__(self)
         self.control_keys += (ui.EKeySelect,)
         self.args = u''
+        self.code_tree = self.code_tree_revision = None
         self.menu.insert(0, ui.MenuItem(_('Run'), target=self.run_click))
         edit_menu = self.menu.find(title=_('Edit'))[0].submenu
         edit_menu.append(ui.MenuItem(_('Code Browser'), target=self.codebrowser_click))
+        edit_menu.append(ui.MenuItem(_('Go to Symbol...'), target=self.gotosymbol_click))
 
     def enter_key_press(self):
         TextFileWindow.enter_key_press(self)
@@ -1302,17 +3623,15 @@ class PythonFileWindow(TextFileWindow, PythonModifier):
         menu.extend(PythonModifier.get_shortcuts())
         menu.append(ui.MenuItem(_('Run'), method=cls.run_click))
         menu.append(ui.MenuItem(_('Code Browser'), method=cls.codebrowser_click))
+        menu.append(ui.MenuItem(_('Go to Symbol...'), method=cls.gotosymbol_click))
         return menu
     get_shortcuts = classmethod(get_shortcuts)
 
     def run_click(self):
         TextFileWindow.store_session()
-        try:
-            if self.load()[0] == self.body.get():
-                path = self.path
-            else:
-                raise IOError
-        except IOError:
+        if self.path is not None and not self.is_modified():
+            path = self.path
+        else:
             # save to temp file
             dirpath = 'D:\\Ped.temp'
             if not os.path.exists(dirpath):
@@ -1323,9 +3642,10 @@ class PythonFileWindow(TextFileWindow, PythonModifier):
             path = os.path.join(dirpath, self.title.encode('utf8'))
             try:
                 f = file(path, 'w')
-                f.write(self.body.get().translate({0x2028: 0x2029, 0xa0: 0x20}).replace(u'\u2029',
-                    u'\r\n').encode(self.encoding))
-                f.close()
+                try:
+                    write_text(f, self.body, self.encoding)
+                finally:
+                    f.close()
             except IOError, (errno, errstr):
                 ui.note(unicode(errstr), 'error')
                 return
@@ -1383,6 +3703,7 @@ class PythonFileWindow(TextFileWindow, PythonModifier):
             if m not in modules:
                 del sys.modules[m]
         sys.argv, sys.path, sys.modules = mysys
+        PythonModifier.py_attrs_cache.clear()
         shell = StdIOWrapper.shell()
         shell.lock(False)
         ui.screen.redraw()
@@ -1398,7 +3719,7 @@ class PythonFileWindow(TextFileWindow, PythonModifier):
         remove('D:\\Ped.temp')
 
     def goto_error(self, lineno, text=None):
-        ln, pos, line = self.get_lines()[lineno - 1]
+        ln, pos, line = self.get_line(lineno)
         if text:
             c = line.find(text)
             if c > 0:
@@ -1413,6 +3734,10 @@ class PythonFileWindow(TextFileWindow, PythonModifier):
         if pos is not None:
             self.body.set_pos(pos)
 
+    def gotosymbol_click(self):
+        app.gotosymbol(self)
+        self.reset_control_key()
+
     def set_shortcuts(self):
         TextFileWindow.set_shortcuts(self)
         items = dict(self.get_shortcuts_items())
@@ -1427,60 +3752,586 @@ class PythonFileWindow(TextFileWindow, PythonModifier):
             else:
                 self.set_shortcut(key, None)
 
-    # parses Python code represented by lines (as returned by self.get_lines())
-    # and returns a tree containing all classes and functions defined by this code in
-    # following format:
-    #   {name: (pos, {subname: (subpos, {})}), name2: (pos2, {})}
-    # if name ends with '()' then it is a function
+    # parses Python code represented by lines (as returned by self.get_lines(),
+    # the text of this window by default) and returns the tree of all classes
+    # and functions defined by this code as the root PythonCodeNode; names
+    # duplicated in a class or function get the position appended (name:pos)
     def parse_lines(self, lines=None):
         if lines is None:
-            lines = self.get_lines()
-        flines = []
-        idx = 0
-        for lnum, lpos, ln in lines:
-            t = ln.strip()
-            if not t:
-                continue
-            ind = ln.find(t[0])
-            flines.append((idx, ind, lpos, t))
-            idx += 1
-        end = {u'class' : u'', u'def' : u'()'}
-        last = root = {}
-        lev = [(0, root)] # indent, tree
-        for idx, ind, lpos, ln in flines:
-            t = ln.split()
-            if ind < lev[-1][0]:
-                if idx > 0:
-                    if flines[idx-1][-1][-1] in (u',', u'\\'):
-                        # current line is a continuation of previous line
-                        flines[idx] = (idx, flines[idx-1][1], lpos, ln)
-                        continue
-                    if ind < flines[idx-1][1]:
-                        pln = flines[idx-1][-1]
-                        p = max(pln.find(u"'''"), pln.find(u'"""'))
-                        if p >= 0 and p == max(pln.rfind(u"'''"), pln.rfind(u'"""')):
-                            # current line is a continuation of multiline comment
-                            flines[idx] = (idx, flines[idx-1][1], lpos, ln)
-                            continue
-                try:
-                    while ind < lev[-1][0]:
-                        lev.pop()
-                except IndexError:
-                    # error
-                    return
-            elif ind > lev[-1][0]:
-                lev.append((ind, last))
-            if t[0] in end.keys():
-                tok = t[1].split(u'(')[0].split(u':')[0]
-                name = tok+end[t[0]]
-                if name in lev[-1][1]:
+            if self.code_tree_revision == self.get_revision():
+                return self.code_tree
+            tokenizer = self.py_tokenizer
+        else:
+            tokenizer = PythonTokenizer()
+            tokenizer.scan_lines([(lpos, ln) for lnum, lpos, ln in lines])
+        root = PythonCodeNode()
+        lev = [(-1, root, {})] # indent, node, names
+        for ind, kind, name, pos in tokenizer.get_outline():
+            while ind <= lev[-1][0]:
+                lev.pop()
+            if kind in (u'class', u'def'):
+                names = lev[-1][2]
+                if name in names:
                     # duped names, append an integer
-                    name = u'%s:%d%s' % (tok, lpos+ind, end[t[0]])
-                last = {}
-                lev[-1][1][name] = (lpos+ind, last)
+                    name = u'%s:%d' % (name, pos)
+                names[name] = True
+                node = PythonCodeNode(name, kind, pos)
+                lev[-1][1].children.append(node)
+                lev.append((ind, node, {}))
+        root.sort()
+        if lines is None:
+            self.code_tree = root
+            self.code_tree_revision = self.get_revision()
         return root
 
 
+# index of the symbols (see PythonTokenizer.get_symbols()) defined in the
+# Python files found in given paths and in the opened Python files; the
+# symbols of the files are stored in a file together with their
+# modification times and sizes, so only changed files are parsed again
+class SymbolIndex(object):
+    version = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.paths = []
+        # path: (mtime, size, symbols)
+        self.files = {}
+        self.loaded = False
+        self.modified = False
+        self.updater = None
+        # (path, method): (mtime, size, data)
+        self.file_data = {}
+
+    # adds a folder to be indexed; a folder inside of an already added one
+    # is skipped and the added ones inside of the new one are removed, so
+    # no tree is walked twice
+    def add_path(self, path):
+        if not os.path.isdir(path):
+            return
+        def inside(path, root):
+            path = path.lower().rstrip(os.sep) + os.sep
+            return path.startswith(root.lower().rstrip(os.sep) + os.sep)
+        for root in self.paths:
+            if inside(path, root):
+                return
+        self.paths = [x for x in self.paths if not inside(x, path)]
+        self.paths.append(path)
+
+    def load(self):
+        import marshal
+        f = file(self.filename, 'rb')
+        try:
+            if marshal.load(f) != self.version:
+                return
+            while True:
+                try:
+                    path, mtime, size, symbols = marshal.load(f)
+                except EOFError:
+                    break
+                self.files[path] = (mtime, size, symbols)
+        finally:
+            f.close()
+
+    def try_to_load(self):
+        try:
+            self.load()
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        self.loaded = True
+
+    def save(self):
+        import marshal
+        def write(f):
+            marshal.dump(self.version, f)
+            for path, (mtime, size, symbols) in self.files.items():
+                marshal.dump((path, mtime, size, symbols), f)
+        atomic_write(self.filename, write)
+        self.modified = False
+
+    # returns the lines of a text file as (offset, line) tuples; the
+    # list is empty if the file cannot be read
+    def read_lines(self, path):
+        try:
+            text = app.read_text_file(path)
+        except (IOError, UnicodeError):
+            return []
+        if text is None:
+            return []
+        text = text[0]
+        lines = []
+        pos = 0
+        while True:
+            end = text.find(u'\u2029', pos)
+            if end < 0:
+                lines.append((pos, text[pos:]))
+                break
+            lines.append((pos, text[pos:end]))
+            pos = end + 1
+        return lines
+
+    # returns a PythonTokenizer with the code of a Python file
+    def tokenize_file(self, path):
+        tokenizer = PythonTokenizer()
+        tokenizer.scan_lines(self.read_lines(path))
+        return tokenizer
+
+    # returns the symbols of a Python file
+    def parse_file(self, path):
+        return self.tokenize_file(path).get_symbols()
+
+    # returns the result of a PythonTokenizer method (given by name) for
+    # the code in a Python file; opened files are taken from their windows,
+    # the results for the other files are cached until the files change;
+    # default is returned if the file cannot be read
+    def get_file_data(self, path, method, default):
+        for win in ui.screen.find_windows(PythonFileWindow):
+            if win.path is not None and win.path.lower() == path.lower():
+                return getattr(win.py_tokenizer, method)()
+        try:
+            st = os.stat(path)
+        except OSError:
+            return default
+        stamp = (st.st_mtime, st.st_size)
+        entry = self.file_data.get((path, method))
+        if entry is None or entry[:2] != stamp:
+            entry = stamp + (getattr(self.tokenize_file(path), method)(),)
+            self.file_data[(path, method)] = entry
+        return entry[2]
+
+    # returns the definitions (see PythonTokenizer.get_definitions()) of
+    # the code in a Python file
+    def get_file_definitions(self, path):
+        return self.get_file_data(path, 'get_definitions', {})
+
+    # returns the scopes (see PythonTokenizer.get_scopes()) of the code
+    # in a Python file
+    def get_file_scopes(self, path):
+        return self.get_file_data(path, 'get_scopes', [[None, None, -1, 0, None, {}, {}]])
+
+    # generator updating the index; yields after every parsed file
+    # and listed directory
+    def iter_update(self):
+        if not self.loaded:
+            self.try_to_load()
+            yield None
+        found = {}
+        for root in self.paths:
+            for path in app.iter_files(root, ['.py']):
+                if path is None:
+                    yield None
+                    continue
+                if path.lower() in found:
+                    continue
+                found[path.lower()] = True
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stamp = (st.st_mtime, st.st_size)
+                entry = self.files.get(path)
+                if entry is not None and entry[:2] == stamp:
+                    continue
+                self.files[path] = stamp + (self.parse_file(path),)
+                self.modified = True
+                yield None
+        for path in self.files.keys():
+            if path.lower() not in found:
+                del self.files[path]
+                self.modified = True
+        if self.modified:
+            try:
+                self.save()
+            except (IOError, OSError):
+                pass
+
+    # starts updating the index in the background
+    def start_update(self):
+        if self.updater is None:
+            self.updater = self.iter_update()
+            ui.schedule(self.update_step)
+
+    # runs one step of the update, the next one is scheduled if
+    # reschedule is True
+    def update_step(self, reschedule=True):
+        if self.updater is None:
+            return
+        try:
+            self.updater.next()
+        except StopIteration:
+            self.updater = None
+        else:
+            if reschedule:
+                ui.schedule(self.update_step)
+
+    # finishes the update of the index started by start_update(); the
+    # step already scheduled by the background update finds it done
+    def update(self):
+        while self.updater is not None:
+            self.update_step(False)
+            e32.ao_yield()
+
+    # returns all symbols as (name, kind, location, pos) tuples sorted by
+    # name; location is the path of a file or the window of an opened file
+    def get_symbols(self):
+        self.update()
+        lst = []
+        opened = {}
+        for win in ui.screen.find_windows(PythonFileWindow):
+            if win.path is not None:
+                opened[win.path.lower()] = True
+            for name, kind, pos in win.py_tokenizer.get_symbols():
+                lst.append((name.lower(), name, kind, win, pos))
+        for path, (mtime, size, symbols) in self.files.items():
+            if path.lower() in opened:
+                continue
+            for name, kind, pos in symbols:
+                lst.append((name.lower(), name, kind, path, pos))
+        lst.sort()
+        return [x[1:] for x in lst]
+
+
+# store of the completions independent of the edited code (keywords,
+# statements and module names) kept in an array sorted by lowercase
+# titles, so the completions of a prefix are found by a binary search;
+# it also counts the uses of all completions to rank them, the counts
+# are stored in a file
+class CompletionStore(object):
+    version = 1
+    # maximal number of completions with remembered uses
+    max_counts = 500
+
+    def __init__(self, filename):
+        self.filename = filename
+        # title: offset (see the statements list)
+        self.words = {}
+        # sorted list of (lowercase title, title, offset) tuples and
+        # the list of its lowercase titles
+        self.table = None
+        self.keys = None
+        # title: number of uses
+        self.counts = {}
+        self.loaded = False
+        self.modified = False
+
+    # adds (title, offset) tuples to the store
+    def add_words(self, words):
+        for title, offset in words:
+            self.words[unicode(title)] = offset
+        self.table = None
+
+    def get_table(self):
+        if self.table is None:
+            table = [(title.lower(), title, offset) for title, offset in self.words.items()]
+            table.sort()
+            self.table = table
+            self.keys = [x[0] for x in table]
+        return self.table
+
+    # returns the (title, offset) tuples of the words starting with
+    # prefix, sorted by lowercase titles
+    def find(self, prefix):
+        table = self.get_table()
+        key = prefix.lower()
+        beg = bisect_left(self.keys, key)
+        end = bisect_left(self.keys, key + u'\uffff')
+        return [x[1:] for x in table[beg:end] if x[1].startswith(prefix)]
+
+    # returns the (title, offset) candidates ranked by the number of uses,
+    # the never used ones follow in the original order
+    def rank(self, candidates):
+        if not self.loaded:
+            self.try_to_load()
+        counts = self.counts
+        used = [(-counts[x[0]], x[0].lower(), x) for x in candidates if counts.has_key(x[0])]
+        if not used:
+            return candidates
+        used.sort()
+        return [x[2] for x in used] + [x for x in candidates if not counts.has_key(x[0])]
+
+    # counts a use of a completion
+    def add_use(self, title):
+        if not self.loaded:
+            self.try_to_load()
+        self.counts[title] = self.counts.get(title, 0) + 1
+        if len(self.counts) > self.max_counts:
+            # forget the least used half
+            lst = [(n, t) for t, n in self.counts.items() if t != title]
+            lst.sort()
+            for n, t in lst[:len(lst) - self.max_counts // 2]:
+                del self.counts[t]
+        self.modified = True
+
+    def load(self):
+        import marshal
+        f = file(self.filename, 'rb')
+        try:
+            if marshal.load(f) != self.version:
+                return
+            self.counts = marshal.load(f)
+        finally:
+            f.close()
+
+    def try_to_load(self):
+        try:
+            self.load()
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        self.loaded = True
+
+    def save(self):
+        import marshal
+        f = file(self.filename, 'wb')
+        try:
+            marshal.dump(self.version, f)
+            marshal.dump(self.counts, f)
+        finally:
+            f.close()
+        self.modified = False
+
+    def try_to_save(self):
+        if self.modified:
+            try:
+                self.save()
+            except IOError:
+                pass
+
+
+# index of the names of the modules and packages which can be imported
+# from sys.path; the names found in every directory and zip archive are
+# stored in a file together with its modification time, so only changed
+# directories have to be listed again; nothing is imported
+class ModuleIndex(object):
+    version = 1
+    exts = ('.py', '.pyc', '.pyo', '.pyd')
+
+    def __init__(self, filename):
+        self.filename = filename
+        # path: (mtime, names)
+        self.dirs = {}
+        self.loaded = False
+        self.modified = False
+
+    def load(self):
+        import marshal
+        f = file(self.filename, 'rb')
+        try:
+            if marshal.load(f) != self.version:
+                return
+            while True:
+                try:
+                    path, mtime, names = marshal.load(f)
+                except EOFError:
+                    break
+                self.dirs[path] = (mtime, names)
+        finally:
+            f.close()
+
+    def try_to_load(self):
+        try:
+            self.load()
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        self.loaded = True
+
+    def save(self):
+        import marshal
+        f = file(self.filename, 'wb')
+        try:
+            marshal.dump(self.version, f)
+            for path, (mtime, names) in self.dirs.items():
+                marshal.dump((path, mtime, names), f)
+        finally:
+            f.close()
+        self.modified = False
+
+    def try_to_save(self):
+        if self.modified:
+            try:
+                self.save()
+            except IOError:
+                pass
+
+    def is_package(self, path):
+        for ext in self.exts:
+            if os.path.isfile(os.path.join(path, '__init__' + ext)):
+                return True
+        return False
+
+    # returns the names of the modules and packages in a directory or,
+    # as dotted names, in a zip archive
+    def get_dir_modules(self, path):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return []
+        entry = self.dirs.get(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        if os.path.isdir(path):
+            names = self.list_dir(path)
+        else:
+            names = self.list_zip(path)
+        self.dirs[path] = (mtime, names)
+        self.modified = True
+        return names
+
+    def list_dir(self, path):
+        try:
+            items = os.listdir(path)
+        except OSError:
+            return []
+        names = {}
+        for item in items:
+            name, ext = os.path.splitext(item)
+            if ext.lower() in self.exts:
+                if name != '__init__':
+                    names[name] = True
+            elif not ext and self.is_package(os.path.join(path, item)):
+                names[item] = True
+        return [x.decode('utf8') for x in names.keys()]
+
+    def list_zip(self, path):
+        try:
+            import zipfile
+            z = zipfile.ZipFile(path)
+            try:
+                files = z.namelist()
+            finally:
+                z.close()
+        except Exception:
+            return []
+        names = {}
+        for item in files:
+            parts = item.split('/')
+            name, ext = os.path.splitext(parts[-1])
+            if ext.lower() not in self.exts:
+                continue
+            if name == '__init__':
+                parts = parts[:-1]
+            else:
+                parts[-1] = name
+            if parts:
+                names['.'.join(parts)] = True
+        return [x.decode('utf8') for x in names.keys()]
+
+    # returns the sorted names of the top level modules and packages or
+    # of the modules in a package (dotted name); the directories in
+    # sys.path (and path, for implicit relative imports) are searched
+    def get_modules(self, package=u'', path=None):
+        if not self.loaded:
+            self.try_to_load()
+        names = {}
+        parts = []
+        if package:
+            parts = package.encode('utf8').split('.')
+        else:
+            for name in sys.builtin_module_names:
+                names[unicode(name)] = True
+        paths = list(sys.path)
+        if path is not None:
+            paths.insert(0, path)
+        prefix = u''.join([x + u'.' for x in package.split(u'.') if x])
+        for path in paths:
+            if os.path.isdir(path):
+                path = os.path.join(path, *parts)
+                if parts and not self.is_package(path):
+                    continue
+                for name in self.get_dir_modules(path):
+                    names[name] = True
+            elif os.path.isfile(path):
+                for name in self.get_dir_modules(path):
+                    if name.startswith(prefix) and u'.' not in name[len(prefix):]:
+                        names[name[len(prefix):]] = True
+        names = names.keys()
+        names.sort()
+        return names
+
+
+# database of the arguments and docstrings of the functions and classes
+# created by make_calltips.py; only the index is read into memory, the
+# entries are read from the file when needed
+class CalltipDatabase(object):
+    magic = 'PCT1'
+
+    def __init__(self, filename):
+        self.filename = filename
+        # 'module.name': (offset, size)
+        self.index = None
+
+    def load_index(self):
+        import marshal, struct
+        self.index = {}
+        f = file(self.filename, 'rb')
+        try:
+            if f.read(len(self.magic)) != self.magic:
+                return
+            offset = struct.unpack('<I', f.read(4))[0]
+            f.seek(offset)
+            self.index = marshal.load(f)
+        finally:
+            f.close()
+
+    # returns the (args, doc) tuple of the first of the dotted names
+    # found in the database or None
+    def find(self, names):
+        if self.index is None:
+            try:
+                self.load_index()
+            except (IOError, EOFError, ValueError, TypeError):
+                pass
+        for name in names:
+            entry = self.index.get(name)
+            if entry is not None:
+                break
+        else:
+            return None
+        import marshal
+        offset, size = entry
+        try:
+            f = file(self.filename, 'rb')
+            try:
+                f.seek(offset)
+                return marshal.loads(f.read(size))
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+
+class SymbolsWindow(Window, ui.FilteredListboxModifier):
+    def __init__(self, **kwargs):
+        self.symbols = pop(kwargs, 'symbols')
+        kwargs.setdefault('title', _('Go to Symbol'))
+        Window.__init__(self, **kwargs)
+        ui.FilteredListboxModifier.__init__(self, (_('(no match)'), u''))
+        self.set_listbox(self.make_display_list(), self.select_click)
+        self.menu = ui.Menu()
+        self.menu.append(ui.MenuItem(_('Select'), target=self.select_click))
+        self.menu.append(self.filter_menu_item)
+        self.menu.append(ui.MenuItem(_('Exit'), target=self.close))
+
+    def make_display_list(self):
+        lst = []
+        for name, kind, location, pos in self.symbols:
+            if kind == u'def':
+                name = u'%s()' % name
+            if isinstance(location, Window):
+                location = location.title
+            else:
+                location = location.decode('utf8')
+            lst.append((name, location))
+        if not lst:
+            lst.append((_('(no data)'), u''))
+        return lst
+
+    def select_click(self):
+        i = self.current()
+        if 0 <= i < len(self.symbols):
+            self.modal_result = self.symbols[i]
+            self.close()
+
+
 class IOWindow(TextWindow):
     def __init__(self, **kwargs):
         TextWindow.__init__(self, **kwargs)
@@ -1488,18 +4339,28 @@ class IOWindow(TextWindow):
         self.event = None
         self.locked = None
         self.write_buf = []
-        def make_flusher(body, buf):
+        def make_flusher(body, buf, table, changed):
             def doflush():
                 # insert the strings in place
-                body.add(u''.join(buf))
+                text = u''.join(buf)
+                pos = body.get_pos()
+                first = table.sync(pos)
+                body.add(text)
+                table.inserted(pos, text)
                 del buf[:]
+                if first is not None:
+                    pos = min(pos, first)
                 # while the len exceeds 3000 chars, we remove first 250
                 while body.len() > 3000:
                     body.delete(0, 250)
+                    table.deleted(0, 250)
+                    pos = 0
+                changed(pos)
                 # update the Text object on screen
                 e32.ao_yield()
             return doflush
-        self.do_flush = make_flusher(self.body, self.write_buf)
+        self.do_flush = make_flusher(self.body, self.write_buf, self.line_table,
+            self.text_changed)
         self.flush_gate = e32.ao_callgate(self.do_flush)
 
     def control_key_press(self, key):
@@ -1686,24 +4547,24 @@ class PythonShellWindow(IOWindow, PythonModifier):
             try:
                 statement = self.history[self.history_ptr]
                 try:
-                    self.body.delete(self.prompt_pos)
+                    self.delete_text(self.prompt_pos)
                 except SymbianError:
                     pass
                 self.body.set_pos(self.prompt_pos)
                 self.write('\n'.join(statement))
                 ui.schedule(self.body.set_pos, self.body.get_pos())
             except IndexError:
-                self.body.delete(self.prompt_pos)
+                self.delete_text(self.prompt_pos)
                 ui.schedule(self.body.set_pos, self.prompt_pos)
         elif key == ui.EKeyBackspace:
             if not self.is_locked():
                 pos = self.body.get_pos()
                 if pos >= self.prompt_pos:
                     if pos == self.prompt_pos:
-                        self.body.add(u' ')
+                        self.add_text(u' ')
                     if self.body.len() > self.prompt_pos:
                         def clear():
-                            self.body.delete(self.prompt_pos)
+                            self.delete_text(self.prompt_pos)
                             self.body.set_pos(self.prompt_pos)
                         ui.schedule(clear)
                         self.reset_control_key()
@@ -1744,6 +4605,26 @@ class PythonShellWindow(IOWindow, PythonModifier):
         self.prompt_pos = self.body.get_pos()
         self.statement = []
 
+    # the output in the shell would confuse the tokenizer of the window,
+    # only the current statement is tokenized
+    def py_get_indent(self):
+        pos = self.body.get_pos()
+        start = self.prompt_pos
+        if pos < start:
+            # previous line only
+            start = self.get_line(max(self.get_line_table().index(pos), 1))[1]
+        text = self.body.get(start, pos - start).replace(u'\u2028', u'\u2029')
+        lines = []
+        for line in text.split(u'\u2029'):
+            lines.append((start, line))
+            start += len(line) + 1
+        if len(lines) < 2:
+            return 0
+        tokenizer = PythonTokenizer()
+        tokenizer.scan_lines(lines[:-1])
+        return tokenizer.get_indent(len(lines) - 1, app.settings.python.indentsize,
+            lines[-2][1])
+
     def enter_key_press(self):
         if IOWindow.enter_key_press(self):
             return
@@ -1752,7 +4633,7 @@ class PythonShellWindow(IOWindow, PythonModifier):
         pos = self.body.get_pos()
         # remove new line character
         if pos > 0 and self.body.get(pos-1, 1) in (u'\u2028', u'\u2029'):
-            self.body.delete(pos-1, 1)
+            self.delete_text(pos-1, 1)
             pos -= 1
         if pos < self.prompt_pos:
             # cursor was moved before the statement start
@@ -1842,7 +4723,7 @@ class PythonShellWindow(IOWindow, PythonModifier):
         if ptr is not None:
             self.history_ptr = ptr
             statement = self.history[ptr]
-            self.body.delete(self.prompt_pos)
+            self.delete_text(self.prompt_pos)
             self.body.set_pos(self.prompt_pos)
             self.write('\n'.join(statement))
 
@@ -1855,15 +4736,16 @@ class PythonShellWindow(IOWindow, PythonModifier):
             return
         try:
             f = file(path, 'w')
-            f.write(self.body.get().translate({0x2028: 0x2029, 0xa0: 0x20}).replace(u'\u2029',
-                u'\r\n').encode(app.settings.file.encoding))
-            f.close()
+            try:
+                write_text(f, self.body, app.settings.file.encoding)
+            finally:
+                f.close()
         except IOError:
             ui.note(_('Cannot export the output'), 'error')
 
     def clear_click(self):
         if ui.query(_('Clear the buffer?'), 'query'):
-            self.body.clear()
+            self.set_text(u'')
             self.prompt()
 
     def move_beg_of_line(self, immediate=True, force=False):
@@ -1934,7 +4816,7 @@ class HelpWindow(TextWindow):
             offset += len(ln)
             if ln.endswith('\r\n'):
                 offset -= 1
-        self.body.set(''.join(lines))
+        self.set_text(''.join(lines))
         self.body.set_pos(0)
 
     def add_to_history(self, pos=None):
@@ -1947,7 +4829,7 @@ class HelpWindow(TextWindow):
 
     def enter_key_press(self):
         pos = self.body.get_pos()-1
-        self.body.delete(pos, 1)
+        self.delete_text(pos, 1)
         lnum, offset, ln = self.get_line_from_pos(pos)
         pos -= offset
         br1 = ln.rfind(u'[', 0, pos)
@@ -2190,9 +5072,7 @@ class PluginsWindow(Window):
             pathpart, name = os.path.split(p)
             ensurepath(pathpart)
             if name:
-                fh = file(p, 'wb')
-                fh.write(z.read(f.filename))
-                fh.close()
+                atomic_write(p, z.read(f.filename))
         z.close()
         # manifest could be changed so save it
         manifest.save(os.path.join(path, 'manifest.txt'))
@@ -2282,9 +5162,13 @@ class Application(object):
         settings.text.append('pagesizefull', ui.IntegerSetting(_('Page size (full screen)'), 11, vmin=1, vmax=64))
         settings.text.append('pagesizeport', ui.IntegerSetting(_('Page size (portrait)'), 8, vmin=1, vmax=64))
         settings.text.append('pagesizeland', ui.IntegerSetting(_('Page size (landscape)'), 9, vmin=1, vmax=64))
+        settings.text.append('findcase', ui.BoolSetting(_('Find: match case'), False))
+        settings.text.append('findwords', ui.BoolSetting(_('Find: whole words'), False))
+        settings.text.append('findregex', ui.BoolSetting(_('Find: regular expressions'), False))
         settings.text.append('shortcuts', ShortcutsGroupSetting(_('Text shortcuts'), TextWindow, True))
         settings.file.append('encoding', ui.ChoiceSetting(_('Default encoding'), 'utf-8', ('ascii', 'latin-1', 'utf-8', 'utf-16')))
         settings.file.append('autosave', ui.ChoiceValueSetting(_('Autosave'), 0, ((_('Off'), 0), (_('%d sec') % 30, 30), (_('%d min') % 1, 60), (_('%d min') % 2, 120), (_('%d min') % 5, 300), (_('%d min') % 10, 600))))
+        settings.file.append('backups', ui.ChoiceValueSetting(_('Backup copies'), 0, ((_('Off'), 0), (u'1', 1), (u'2', 2), (u'3', 3), (u'5', 5))))
         settings.file.append('shortcuts', ShortcutsGroupSetting(_('Text file shortcuts'), TextFileWindow, True))
         settings.python.append('askforargs', ui.BoolSetting(_('Ask for arguments'), False))
         settings.python.append('shellfontcolor', ui.ChoiceValueSetting(_('Shell font color'), 0x008800, allcolors))
@@ -2317,6 +5201,19 @@ class Application(object):
 
         # properties initialization
         self.browser_win = self.help_win = self.plugins_win = None
+        self.symbol_index = SymbolIndex(os.path.join(self.path, 'symbols.bin'))
+        self.completion_store = CompletionStore(os.path.join(self.path, 'completion.bin'))
+        self.module_index = ModuleIndex(os.path.join(self.path, 'modules.bin'))
+        self.calltips = CalltipDatabase(os.path.join(self.path, 'calltips.bin'))
+        self.autosave = AutosaveScheduler()
+        self.recovery = RecoveryJournal(os.path.join(self.path, 'recovery'))
+        self.completion_store.add_words(statements)
+        firsts = dict([(x[0].split()[0], True) for x in statements])
+        self.completion_store.add_words([(x, None) for x in PythonTokenizer.keywords.keys() \
+            if not firsts.has_key(x)])
+        self.completion_store.add_words([(x, None) for x in \
+            list(sys.builtin_module_names) + sys.modules.keys() if '.' not in x])
+        self.findinfiles_exts = u'.py .txt'
         self.unnamed_count = 1
         self.started_plugins = {}
         
@@ -2332,7 +5229,8 @@ class Application(object):
                 for win in ui.screen.find_windows(PythonFileWindow):
                     try:
                         if win.path.lower() == path:
-                            win.save()
+                            if win.is_modified():
+                                win.save()
                             return reload(mod)
                     except AttributeError:
                         pass
@@ -2350,6 +5248,8 @@ class Application(object):
         for path in ('C:\\Python\\lib', 'E:\\Python\\lib'):
             if os.path.exists(path):
                 sys.path.append(path)
+        for path in ('C:\\Python', 'E:\\Python', 'C:\\Python\\lib', 'E:\\Python\\lib'):
+            self.symbol_index.add_path(path)
 
         # load and apply settings
         self.settings.try_to_load()
@@ -2368,6 +5268,9 @@ class Application(object):
         main_menu.append(ui.MenuItem(_('Windows'), submenu=ui.Menu(), hidden=True))
         main_menu.append(ui.MenuItem(_('Python Shell'), target=StdIOWrapper.shell))
         main_menu.append(ui.MenuItem(_('Run Script...'), target=self.runscript_click))
+        main_menu.append(ui.MenuItem(_('Find in Files...'), target=self.findinfiles_click))
+        main_menu.append(ui.MenuItem(_('Replace in Files...'), target=self.replaceinfiles_click))
+        main_menu.append(ui.MenuItem(_('Go to Symbol...'), target=self.gotosymbol_click))
         tools_menu = ui.Menu(_('Tools'))
         tools_menu.append(ui.MenuItem(_('Settings'), target=self.settings_click))
         tools_menu.append(ui.MenuItem(_('Plugins'), target=self.plugins_click))
@@ -2382,15 +5285,42 @@ class Application(object):
 
         # restore session
         self.restore_session()
+
+        # update the symbol index in the background
+        ui.schedule(self.symbol_index.start_update)
         
         # the ui is set up now so we can simply leave and the launchpad will keep us
         # running until appuifw.app.set_exit() is called (see: RootWindow.close)
 
+    # restores the windows stored in the session file and the unsaved
+    # changes recorded in the recovery journals, including the journals
+    # left after a crash which are not in the session file
     def restore_session(self):
         TextFileWindow.session.try_to_load()
         windows = TextFileWindow.session.windows
-        if windows and ui.query(_('Restore previous session?'), 'query'):
+        stored = dict([(x[1], True) for x in windows if isinstance(x[1], str)])
+        lost = [x for x in self.recovery.get_filenames() if not stored.has_key(x)]
+        if (windows or lost) and ui.query(_('Restore previous session?'), 'query'):
+            for journal in lost:
+                windows.append((None, journal, None, None))
             for path, text, encoding, pos in windows:
+                journal = None
+                if isinstance(text, str):
+                    # replay the journal
+                    journal = text
+                    data = self.recovery.read(journal)
+                    if data is None:
+                        if path is None:
+                            path = journal
+                        ui.note(_('Cannot recover %s') % os.path.split(path)[1].decode('utf8'), 'error')
+                        try:
+                            os.remove(journal)
+                        except OSError:
+                            pass
+                        continue
+                    path, encoding, text, jpos = data
+                    if pos is None:
+                        pos = jpos
                 if text is None:
                     win = self.load_file(path)
                     if win:
@@ -2404,7 +5334,7 @@ class Application(object):
                     ui.screen.open_blank_window(_('Please wait...'))
                     win = klass(title=os.path.split(path)[1].decode('utf8'))
                     if win:
-                        win.body.set(text)
+                        win.set_text(text)
                         win.body.set_pos(pos)
                         win.encoding = encoding
                         if os.path.split(path)[0]:
@@ -2412,7 +5342,11 @@ class Application(object):
                             win.fixed_encoding = True
                         else:
                             win.fixed_encoding = False
+                        if journal is not None:
+                            win.journal.adopt(journal)
                         win.open()
+        else:
+            self.recovery.clear()
         del windows[:]
         try:
             TextFileWindow.session.save()
@@ -2490,6 +5424,7 @@ class Application(object):
 
     def apply_settings(self):
         GlobalWindowModifier.update_settings()
+        self.autosave.restart()
         if self.language != self.settings.main.language.encode('utf8'):
             ui.note(_('Restart Ped for the changes to take effect'))
 
@@ -2541,12 +5476,19 @@ class Application(object):
             return
         self.load_file(path)
 
-    def load_file(self, path):
-        # check if this file isn't already opened
+    # returns the window of an opened file or None
+    def find_file_window(self, path):
         for win in ui.screen.find_windows(TextFileWindow):
             if win.path == path:
-                win.focus = True
-                return
+                return win
+        return None
+
+    def load_file(self, path):
+        # check if this file isn't already opened
+        win = self.find_file_window(path)
+        if win is not None:
+            win.focus = True
+            return win
         ext = os.path.splitext(path)[1].lower()
         try:
             klass = file_windows_types[[x.type_ext.lower() for x in file_windows_types].index(ext)]
@@ -2562,6 +5504,244 @@ class Application(object):
             wwin.close()
         return win
 
+    def findinfiles_click(self):
+        self.findinfiles()
+
+    # asks for the folder, file extensions and text to find; path and
+    # find_text are the defaults; returns a (path, exts, search) tuple
+    # or None if cancelled
+    def ask_findinfiles(self, title, path=None, find_text=u''):
+        path = self.ask_folder(title, path)
+        if path is None:
+            return None
+        exts = ui.query(_('File extensions:'), 'text', self.findinfiles_exts)
+        if exts is None:
+            return None
+        self.findinfiles_exts = exts
+        find_text = ui.query(_('Find:'), 'text', find_text)
+        if not find_text:
+            return None
+        search = TextSearch()
+        if not search.set_find_text(find_text):
+            return None
+        exts = ['.%s' % x.lstrip('*.') for x in exts.lower().encode('utf8').split()
+            if x.lstrip('*.')]
+        return path, exts, search
+
+    # lets the user choose a folder; returns its path or None, path is
+    # the default
+    def ask_folder(self, title, path=None):
+        if self.browser_win:
+            ui.note(_('File browser already in use'), 'error')
+            return None
+        self.browser_win = ui.FileBrowserWindow(mode=ui.fbmFolder,
+            path=os.path.join(path or '', ''),
+            title=title)
+        path = self.browser_win.modal()
+        self.browser_win = None
+        if not path:
+            return None
+        return path
+
+    # opens a window with the results of a search in files; path and
+    # find_text are the defaults
+    def findinfiles(self, path=None, find_text=u''):
+        args = self.ask_findinfiles(_('Find in Files'), path, find_text)
+        if args is None:
+            return
+        path, exts, search = args
+        win = FindInFilesWindow(title=_('Find: %s') % search.options[0],
+            results=self.iter_findinfiles(path, exts, search))
+        win.open()
+
+    # generator yielding the paths of all files under path with one of the
+    # extensions exts (all files if empty); yields None after every listed
+    # directory to let the event loop run
+    def iter_files(self, path, exts):
+        dirs = [path]
+        while dirs:
+            path = dirs.pop(0)
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+            names.sort()
+            yield None
+            for name in names:
+                filename = os.path.join(path, name)
+                if os.path.isdir(filename):
+                    dirs.append(filename)
+                elif not exts or os.path.splitext(name)[1].lower() in exts:
+                    yield filename
+
+    # returns a (text, encoding) tuple with the decoded contents of a file
+    # (see TextFileWindow.read_file()) or None if it is a binary file
+    def read_text_file(self, filename):
+        f = file(filename, 'rb')
+        try:
+            if TextFileWindow.is_binary(f.read(1024)):
+                return None
+            f.seek(0)
+            return TextFileWindow.read_file(f)
+        finally:
+            f.close()
+
+    # generator yielding the Find in Files results (see FindInFilesWindow);
+    # yields None after every file to let the event loop run
+    def iter_findinfiles(self, path, exts, search):
+        for filename in self.iter_files(path, exts):
+            yield None
+            if filename is None:
+                continue
+            try:
+                text = self.read_text_file(filename)
+            except (IOError, UnicodeError):
+                continue
+            if text is None:
+                continue
+            text = text[0]
+            ln = 1
+            lpos = 0
+            lend = -1
+            for start, end in search.iter_text_matches(search.normalize(text)):
+                if start > lend:
+                    ln += text.count(u'\u2029', lpos, start)
+                    lpos = text.rfind(u'\u2029', 0, start) + 1
+                    lend = text.find(u'\u2029', start)
+                    if lend < 0:
+                        lend = len(text)
+                    line = text[lpos:lend]
+                yield (filename, ln, start - lpos, line)
+
+    # generator yielding the occurrences of a name (see FindInFilesWindow)
+    # in the opened Python files (taken from the name indexes of their
+    # tokenizers) and in the other Python files under path (if given);
+    # yields None after every file read to let the event loop run
+    def iter_references(self, name, path=None):
+        opened = {}
+        for win in ui.screen.find_windows(PythonFileWindow):
+            if win.path is not None:
+                opened[win.path.lower()] = True
+            for pos in win.py_tokenizer.get_names().get(name, []):
+                ln, lpos, line = win.get_line_from_pos(pos)
+                yield (win, ln, pos - lpos, line)
+        if path is None:
+            return
+        for filename in self.iter_files(path, ['.py']):
+            yield None
+            if filename is None or filename.lower() in opened:
+                continue
+            lines = self.symbol_index.read_lines(filename)
+            tokenizer = PythonTokenizer()
+            tokenizer.scan_lines(lines)
+            tokens = tokenizer.tokens
+            for i in xrange(len(tokens)):
+                for col, kind, value in tokens[i]:
+                    if kind == 'name' and value == name:
+                        yield (filename, i + 1, col, lines[i][1])
+
+    def replaceinfiles_click(self):
+        self.replaceinfiles()
+
+    # asks for the folder, file extensions, text to find and replacement,
+    # lets the user choose from the files with matches and replaces the
+    # text in them; every file is rewritten at once, opened files are
+    # changed in their windows; path, find_text and replace_text are
+    # the defaults
+    def replaceinfiles(self, path=None, find_text=u'', replace_text=u''):
+        import re
+        args = self.ask_findinfiles(_('Replace in Files'), path, find_text)
+        if args is None:
+            return
+        path, exts, search = args
+        replace_text = ui.query(_('Replace with:'), 'text', replace_text)
+        if replace_text is None:
+            return
+        # count the matches to let the user choose the files
+        menu = ui.Menu(_('Replace in Files'))
+        wwin = ui.screen.open_blank_window(_('Searching...'))
+        try:
+            for filename in self.iter_files(path, exts):
+                if filename is None:
+                    e32.ao_yield()
+                    continue
+                win = self.find_file_window(filename)
+                if win is not None:
+                    text = win.body.get()
+                else:
+                    try:
+                        text = self.read_text_file(filename)
+                    except (IOError, UnicodeError):
+                        continue
+                    if text is None:
+                        continue
+                    text = text[0]
+                count = len(list(search.iter_text_matches(search.normalize(text))))
+                if count:
+                    name = filename[len(path):].lstrip('\\/').decode('utf8')
+                    menu.append(ui.MenuItem(u'%s (%d)' % (name, count),
+                        filename=filename, name=name))
+                e32.ao_yield()
+        finally:
+            wwin.close()
+        if not menu:
+            ui.note(_('Not found'))
+            return
+        report = ui.Menu(_('Replaced'))
+        for item in menu.multichoice():
+            win = self.find_file_window(item.filename)
+            try:
+                if win is not None:
+                    text, count, pos = search.replace(win.body.get(), replace_text)
+                    win.set_text(text)
+                    win.body.set_pos(pos)
+                    report.append(ui.MenuItem(_('%s: %d (not saved)') % (item.name, count)))
+                else:
+                    count = self.replace_in_file(item.filename, search, replace_text)
+                    report.append(ui.MenuItem(u'%s: %d' % (item.name, count)))
+            except re.error:
+                ui.note(_('Invalid replacement text'), 'error')
+                break
+            except (IOError, OSError, UnicodeError):
+                report.append(ui.MenuItem(_('%s: cannot replace') % item.name))
+        if report:
+            report.popup(full_screen=True)
+
+    # replaces all matches of search in a closed file and writes it
+    # atomically; returns the number of replaced matches
+    def replace_in_file(self, filename, search, replace_text):
+        text = self.read_text_file(filename)
+        if text is None:
+            return 0
+        text, encoding = text
+        text, count, pos = search.replace(text, replace_text)
+        if count:
+            atomic_write(filename, text.replace(u'\u2029', u'\r\n').encode(encoding))
+        return count
+
+    def gotosymbol_click(self):
+        self.gotosymbol()
+
+    # lets the user choose a symbol from the symbol index and shows it
+    def gotosymbol(self, owner=None):
+        # parse the files changed since the last update
+        wwin = ui.screen.open_blank_window(_('Please wait...'))
+        self.symbol_index.start_update()
+        symbols = self.symbol_index.get_symbols()
+        wwin.close()
+        win = SymbolsWindow(symbols=symbols)
+        symbol = win.modal(owner)
+        if symbol is None:
+            return
+        name, kind, location, pos = symbol
+        if isinstance(location, Window):
+            win = location
+            win.focus = True
+        else:
+            win = self.load_file(location)
+        if win:
+            win.body.set_pos(pos)
+
     def runscript_click(self):
         if self.browser_win:
             ui.note(_('File browser already in use'), 'error')
@@ -2608,6 +5788,7 @@ class Application(object):
                 if m not in modules:
                     del sys.modules[m]
             sys.argv, sys.path = mysys
+            PythonModifier.py_attrs_cache.clear()
             TextFileWindow.clear_session()
             shell = StdIOWrapper.shell()
             shell.lock(False)
@@ -2749,11 +5930,7 @@ class Manifest(object):
             f.close()
 
     def save(self, filename):
-        f = open(filename, 'w')
-        try:
-            f.write(self.dump())
-        finally:
-            f.close()
+        atomic_write(filename, self.dump())
 
     def get(self, name, default=None):
         return self.fields.get(name.title(), default)
@@ -2808,6 +5985,104 @@ def quote_split(s):
     return ret
 
 
+def write_text(f, body, encoding, texthash=None):
+    '''Writes the text of a Text control to a file object, converting
+    the line breaks to CRLF. The text is read, converted and encoded in
+    slices, so there is never a copy of the whole text in memory. If
+    texthash (an md5 object) is given, it is updated with the UTF-8
+    encoded text, see TextFileWindow.text_hash().
+    '''
+    if encoding.lower().replace('-', '').replace('_', '') == 'utf16':
+        # the UTF-16 codec would start every slice with a BOM
+        f.write('\xff\xfe')
+        encoding = 'utf-16-le'
+    size = TextFileWindow.chunk_size
+    length = body.len()
+    pos = 0
+    while pos < length:
+        n = min(size, length - pos)
+        text = body.get(pos, n)
+        if pos + n < length and 0xd800 <= ord(text[-1]) < 0xdc00:
+            # keep surrogate pairs together
+            n -= 1
+            text = text[:n]
+        if texthash is not None:
+            texthash.update(text.encode('utf8'))
+        f.write(text.translate({0x2028: 0x2029, 0xa0: 0x20}).replace(u'\u2029',
+            u'\r\n').encode(encoding))
+        pos += n
+
+
+def backup_name(path, n):
+    '''Returns the name of the n-th (1 is the newest) backup copy of a file.
+    '''
+    if n == 1:
+        return path + '.bak'
+    return '%s.bak%d' % (path, n)
+
+
+def atomic_write(path, data, backups=0):
+    '''Replaces the contents of a file with data. The data is written
+    to a temporary file first which is then renamed, so the file is
+    never left partially written. data can also be a function which
+    is called with the file object and writes to it. If backups is not
+    zero, the old file is kept as a backup copy and up to that many of
+    the older copies are kept (see backup_name()).
+    '''
+    # don't touch an existing file with the name of the temporary one
+    temp = path + '.tmp'
+    n = 1
+    while os.path.exists(temp):
+        n += 1
+        temp = '%s.tmp%d' % (path, n)
+    f = file(temp, 'wb')
+    try:
+        try:
+            if callable(data):
+                data(f)
+            else:
+                f.write(data)
+            f.flush()
+        finally:
+            f.close()
+    except:
+        os.remove(temp)
+        raise
+    if backups > 0 and os.path.exists(path):
+        # rotate the backup copies, the oldest one is removed
+        for n in range(backups, 0, -1):
+            if n > 1:
+                src = backup_name(path, n - 1)
+            else:
+                src = path
+            if os.path.exists(src):
+                dst = backup_name(path, n)
+                if os.path.exists(dst):
+                    os.remove(dst)
+                os.rename(src, dst)
+    try:
+        os.rename(temp, path)
+    except OSError:
+        # Symbian can't rename over an existing file
+        os.remove(path)
+        os.rename(temp, path)
+
+
+def merge_sorted(a, b):
+    '''Returns a sorted list of the items of two sorted lists.
+    '''
+    lst = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if b[j] < a[i]:
+            lst.append(b[j])
+            j += 1
+        else:
+            lst.append(a[i])
+            i += 1
+    return lst + a[i:] + b[j:]
+
+
 def repattr(obj, name, value):
     '''Sets an attribute of a class/object. Returns the old value.
     '''
@@ -29,18 +29,16 @@ def comment_line(self):
     pos = self.body.get_pos()
     if self.body.get(pos, 1) == u'#':
         while self.body.get(pos, 1) == u'#':
-            self.body.delete(pos, 1)
+            self.delete_text(pos, 1)
     else:
-        self.body.add(u'#')
+        self.add_text(u'#')
     
     # find the start of next line and go there
-    found = False
-    for ln, lpos, line in self.get_lines():
-        if found:
-            pos = lpos
-            break
-        if lpos == pos:
-            found = True
+    ln = self.get_line_from_pos(pos)[0]
+    try:
+        pos = self.get_line(ln + 1)[1]
+    except IndexError:
+        pass
 
     # move the cursor to the new position
     self.body.set_pos(pos)
@@ -860,6 +860,8 @@ class FilteredListboxModifier(object):
 
     # use instead of body.current(), may return -1 if "nomatch" item is displayed
     def current(self):
+        if self.__filter is None:
+            return self.body.current()
         flst = self.filter_list(self.__list)
         try:
             return self.__list.index(flst[self.body.current()])
@@ -952,7 +954,8 @@ class FilteredListboxModifier(object):
 
 
 fbmOpen, \
-fbmSave = range(2)
+fbmSave, \
+fbmFolder = range(3)
 
 class FileBrowserWindow(Window, FilteredListboxModifier):
     links = []
@@ -1115,6 +1118,8 @@ class FileBrowserWindow(Window, FilteredListboxModifier):
         menu = Menu()
         if self.mode == fbmSave and self.path != '' and not self.path.startswith(':'):
             menu.append(MenuItem(_('Save here...'), target=self.save_click))
+        if self.mode == fbmFolder and self.path != '' and not self.path.startswith(':'):
+            menu.append(MenuItem(_('Select this folder'), target=self.folder_click))
         menu.append(MenuItem(_('Open'), target=self.select_click))
         if self.path.startswith(':'):
             menu.append(MenuItem(_('Drives'), target=self.drives_click))
@@ -1166,7 +1171,9 @@ class FileBrowserWindow(Window, FilteredListboxModifier):
                 self.set_filter(None)
                 self.update()
             elif item[0] == self.FILE:
-                if self.mode == fbmOpen:
+                if self.mode == fbmFolder:
+                    pass
+                elif self.mode == fbmOpen:
                     self.path = os.path.join(self.path, item[3])
                     self.modal_result = self.path
                     self.add_recent(self.path)
@@ -1258,6 +1265,10 @@ class FileBrowserWindow(Window, FilteredListboxModifier):
         self.modal_result = path
         self.close()
 
+    def folder_click(self):
+        self.modal_result = self.path
+        self.close()
+
     def delete_click(self):
         if self.path == ':messages':
             return